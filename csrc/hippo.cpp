@@ -5,17 +5,30 @@ namespace legs {
   at::Tensor euler_backward(const torch::Tensor& mem, const torch::Tensor& input, const float dt);
   at::Tensor trapezoidal(const torch::Tensor& mem, const torch::Tensor& input, const float dt);
   at::Tensor function_approx_trapezoidal(const torch::Tensor& input, const int memorder);
+  at::Tensor trapezoidal_unroll(const torch::Tensor& input, const int memorder);
 }
 
 namespace legt {
   at::Tensor euler_forward(const torch::Tensor& mem, const torch::Tensor& input, const float dt);
 }
 
+namespace cell {
+  std::tuple<at::Tensor, at::Tensor> legs_step(const torch::Tensor& input, const torch::Tensor& h, const torch::Tensor& m,
+                                               const int64_t time_step, const c10::optional<torch::Tensor>& time_steps,
+                                               const int64_t init_t, const int64_t max_length,
+                                               const torch::Tensor& W_uxh, const torch::Tensor& b_uxh,
+                                               const torch::Tensor& W_hxm, const torch::Tensor& b_hxm,
+                                               const torch::Tensor& W_g, const torch::Tensor& b_g);
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("legs_euler_forward", &legs::euler_forward, "Euler forward for Hippo-LegS");
   m.def("legs_euler_backward", &legs::euler_backward, "Euler backward for Hippo-LegS");
   m.def("legs_trapezoidal", &legs::trapezoidal, "Trapezoidal for Hippo-LegS");
   m.def("legs_function_approx_trapezoidal", &legs::function_approx_trapezoidal, "Function approx trapezoidal for Hippo-LegS");
+  m.def("legs_trapezoidal_unroll", &legs::trapezoidal_unroll, "Trapezoidal unroll over a sequence for Hippo-LegS");
 
   m.def("legt_euler_forward", &legt::euler_forward, "Euler forward for Hippo-LegT");
+
+  m.def("legs_cell_step", &cell::legs_step, "Fused step of a gated Hippo-LegS cell");
 }
@@ -0,0 +1,162 @@
+#include <cmath>
+#include <ATen/Parallel.h>
+#include <torch/extension.h>
+
+#define CHECK_DEVICE(x) TORCH_CHECK(x.device().type() == torch::kCPU, #x " must be on CPU")
+
+namespace cell {
+
+// The reductions are vectorized with omp simd (-fopenmp-simd), which allows reassociating the sums
+
+template <typename scalar_t>
+static inline scalar_t dot(const scalar_t* a, const scalar_t* b, int64_t n) {
+  scalar_t sum = 0;
+#pragma omp simd reduction(+:sum)
+  for (int64_t i = 0; i < n; ++i) {
+    sum += a[i] * b[i];
+  }
+  return sum;
+}
+
+template <typename scalar_t>
+static inline void dot2(const scalar_t* a1, const scalar_t* a2, const scalar_t* b, int64_t n, scalar_t& out1, scalar_t& out2) {
+  // Two dot products sharing the loads of b
+  scalar_t sum1 = 0;
+  scalar_t sum2 = 0;
+#pragma omp simd reduction(+:sum1, sum2)
+  for (int64_t i = 0; i < n; ++i) {
+    sum1 += a1[i] * b[i];
+    sum2 += a2[i] * b[i];
+  }
+  out1 += sum1;
+  out2 += sum2;
+}
+
+std::tuple<at::Tensor, at::Tensor> legs_step(const torch::Tensor& input_, const torch::Tensor& h_, const torch::Tensor& m_,
+                                             const int64_t time_step, const c10::optional<torch::Tensor>& time_steps,
+                                             const int64_t init_t, const int64_t max_length,
+                                             const torch::Tensor& W_uxh_, const torch::Tensor& b_uxh,
+                                             const torch::Tensor& W_hxm_, const torch::Tensor& b_hxm,
+                                             const torch::Tensor& W_g_, const torch::Tensor& b_g) {
+  /* One step of a gated HiPPO-LegS cell (MemoryCell with the default architecture, bilinear discretization):
+        u = W_uxh [x, h] + b_uxh
+        m = pad(u) at the first step, else (I - dt/2 A)^{-1} ((I + dt/2 A) m + dt B u) with dt = 1 / min(t, max_length)
+        hidden = tanh(W_hxm [x, m] + b_hxm)
+        g = sigmoid(W_g [x, m] + b_g)
+        h = (1 - g) h + g hidden
+    Parameters:
+        input: (batch_size, input_size)
+        h: (batch_size, hidden_size)
+        m: (batch_size, memsize, memorder)
+        time_step: int shared by the batch, ignored if time_steps is given
+        time_steps: optional (batch_size,) int64 per-sample time steps
+    Returns:
+        h, m: views of a single (batch_size, hidden_size + memsize * memorder) tensor
+  */
+  TORCH_CHECK(input_.dim() == 2, "cell::legs_step: input must have dimension 2");
+  TORCH_CHECK(h_.dim() == 2, "cell::legs_step: h must have dimension 2");
+  TORCH_CHECK(m_.dim() == 3, "cell::legs_step: m must have dimension 3");
+  CHECK_DEVICE(input_);
+  CHECK_DEVICE(h_);
+  CHECK_DEVICE(m_);
+  const auto batch_size = input_.size(0);
+  const auto input_size = input_.size(1);
+  const auto hidden_size = h_.size(1);
+  const auto memsize = m_.size(1);
+  const auto N = m_.size(2);
+  const auto K = input_size + memsize * N;
+  TORCH_CHECK(W_uxh_.size(0) == memsize && W_uxh_.size(1) == input_size + hidden_size, "cell::legs_step: W_uxh has the wrong shape");
+  TORCH_CHECK(W_hxm_.size(0) == hidden_size && W_hxm_.size(1) == K, "cell::legs_step: W_hxm has the wrong shape");
+  TORCH_CHECK(W_g_.size(0) == hidden_size && W_g_.size(1) == K, "cell::legs_step: W_g has the wrong shape");
+  // Rows of the memory are read as contiguous vectors; the state returned by the previous step already satisfies this
+  const auto input = input_.contiguous();
+  const auto h = h_.contiguous();
+  const auto m = (m_.stride(2) == 1 && m_.stride(1) == N) ? m_ : m_.contiguous();
+  const auto W_uxh = W_uxh_.contiguous();
+  const auto W_hxm = W_hxm_.contiguous();
+  const auto W_g = W_g_.contiguous();
+  at::Tensor steps;
+  if (time_steps.has_value()) {
+    TORCH_CHECK(time_steps->numel() == batch_size, "cell::legs_step: time_steps must have one entry per sample");
+    steps = time_steps->to(torch::kLong).contiguous();
+  }
+
+  // The only allocation: the new hidden state and memory side by side
+  auto out = torch::empty({batch_size, hidden_size + memsize * N}, input.options());
+  const auto out_stride = out.stride(0);
+
+  AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "cell::legs_step", [&] {
+    const scalar_t* x_p = input.data_ptr<scalar_t>();
+    const scalar_t* h_p = h.data_ptr<scalar_t>();
+    const scalar_t* m_p = m.data_ptr<scalar_t>();
+    const auto m_stride = m.stride(0);
+    const scalar_t* W_uxh_p = W_uxh.data_ptr<scalar_t>();
+    const scalar_t* b_uxh_p = b_uxh.data_ptr<scalar_t>();
+    const scalar_t* W_hxm_p = W_hxm.data_ptr<scalar_t>();
+    const scalar_t* b_hxm_p = b_hxm.data_ptr<scalar_t>();
+    const scalar_t* W_g_p = W_g.data_ptr<scalar_t>();
+    const scalar_t* b_g_p = b_g.data_ptr<scalar_t>();
+    const int64_t* steps_p = steps.defined() ? steps.data_ptr<int64_t>() : nullptr;
+    scalar_t* out_p = out.data_ptr<scalar_t>();
+
+    // Memory projection and update, parallel over (batch, memsize)
+    const int64_t grain_m = std::max<int64_t>(1, 32768 / (input_size + hidden_size + 4 * N));
+    at::parallel_for(0, batch_size * memsize, grain_m, [&](int64_t begin, int64_t end) {
+      for (int64_t i = begin; i < end; ++i) {
+        const int64_t b = i / memsize;
+        const int64_t msz = i % memsize;
+        const scalar_t* w = W_uxh_p + msz * (input_size + hidden_size);
+        const scalar_t u_val = b_uxh_p[msz] + dot(w, x_p + b * input_size, input_size)
+                                            + dot(w + input_size, h_p + b * hidden_size, hidden_size);
+        const scalar_t* mem = m_p + b * m_stride + msz * N;
+        scalar_t* newmem = out_p + b * out_stride + hidden_size + msz * N;
+        int64_t t = (steps_p != nullptr ? steps_p[b] : time_step) - 1 + init_t;
+        if (t < 0) {
+          newmem[0] = u_val;
+          for (int64_t n = 1; n < N; ++n) {
+            newmem[n] = 0;
+          }
+          continue;
+        }
+        if (t >= max_length) t = max_length - 1;
+        const scalar_t dt = scalar_t(1) / scalar_t(t + 1);
+        const scalar_t input_val_dt = u_val * dt;
+        scalar_t cumsum_fwd = 0;
+        scalar_t cumsum_bwd = 0;
+        for (int64_t n = 0; n < N; ++n) {
+          const scalar_t x = mem[n];
+          const scalar_t sqrt_scale = std::sqrt(scalar_t(2 * n + 1));
+          const scalar_t out_fwd = x - dt / 2 * (cumsum_fwd * sqrt_scale + x * (n + 1)) + input_val_dt * sqrt_scale;
+          cumsum_fwd += x * sqrt_scale;
+          const scalar_t y = (out_fwd - dt / 2 * cumsum_bwd * sqrt_scale) * (1 / (1 + (n + 1) * dt / 2));
+          newmem[n] = y;
+          cumsum_bwd += y * sqrt_scale;
+        }
+      }
+    });
+
+    // Hidden projection, gate and blend, parallel over hidden_size: consecutive samples reuse the same weight rows
+    const int64_t grain_h = std::max<int64_t>(1, 32768 / (2 * K * batch_size));
+    at::parallel_for(0, hidden_size, grain_h, [&](int64_t begin, int64_t end) {
+      for (int64_t j = begin; j < end; ++j) {
+        const scalar_t* w_h = W_hxm_p + j * K;
+        const scalar_t* w_g = W_g_p + j * K;
+        for (int64_t b = 0; b < batch_size; ++b) {
+          const scalar_t* newmem = out_p + b * out_stride + hidden_size;
+          scalar_t hidden_preact = b_hxm_p[j];
+          scalar_t g_preact = b_g_p[j];
+          dot2(w_h, w_g, x_p + b * input_size, input_size, hidden_preact, g_preact);
+          dot2(w_h + input_size, w_g + input_size, newmem, memsize * N, hidden_preact, g_preact);
+          const scalar_t hidden = 1 - 2 / (std::exp(2 * hidden_preact) + 1); // tanh
+          const scalar_t g = 1 / (1 + std::exp(-g_preact));
+          out_p[b * out_stride + j] = (1 - g) * h_p[b * hidden_size + j] + g * hidden;
+        }
+      }
+    });
+  });
+  auto h_new = out.narrow(1, 0, hidden_size);
+  auto m_new = out.narrow(1, hidden_size, memsize * N).view({batch_size, memsize, N});
+  return std::make_tuple(h_new, m_new);
+}
+
+} // cell
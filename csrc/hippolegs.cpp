@@ -1,6 +1,7 @@
 #include <vector>
 #include <utility>
 #include <cmath>
+#include <ATen/Parallel.h>
 #include <torch/extension.h>
 
 #define CHECK_DEVICE(x) TORCH_CHECK(x.device().type() == torch::kCPU, #x " must be on CPU")
@@ -164,4 +165,69 @@ at::Tensor function_approx_trapezoidal(const torch::Tensor& input, const int mem
   return mem;
 }
 
+at::Tensor trapezoidal_unroll(const torch::Tensor& input, const int memorder) {
+  /* All the memories of the bilinear recurrence mem_t = trapezoidal(mem_{t-1}, input_{t-1}, 1/t), from mem_0 = 0
+    Parameters:
+        input: (length, batch_size)
+        memorder: int
+    Returns:
+        mem: (length, batch_size, memorder)
+  */
+  TORCH_CHECK(input.dim() == 2, "legs::trapezoidal_unroll: input must have dimension 2");
+  CHECK_DEVICE(input);
+  const auto length = input.size(0);
+  const auto batch_size = input.size(1);
+  const int64_t N = memorder;
+  // Blocks of sequences are advanced together: the recurrence over n is sequential, but the same across the batch,
+  // so that the inner loop over a block vectorizes
+  constexpr int64_t block = 16;
+  auto mem = torch::empty({length, batch_size, N}, input.options());
+  AT_DISPATCH_FLOATING_TYPES(input.scalar_type(), "legs::trapezoidal_unroll", [&] {
+    const auto input_a = input.accessor<scalar_t, 2>();
+    auto mem_a = mem.accessor<scalar_t, 3>();
+    std::vector<scalar_t> sqrt_scale(N);
+    for (int64_t n = 0; n < N; ++n) {
+      sqrt_scale[n] = std::sqrt(scalar_t(2 * n + 1));
+    }
+    at::parallel_for(0, (batch_size + block - 1) / block, 1, [&](int64_t begin, int64_t end) {
+      std::vector<scalar_t> state(N * block); // (N, block)
+      for (int64_t blk = begin; blk < end; ++blk) {
+        const int64_t b0 = blk * block;
+        const int64_t nb = std::min(block, batch_size - b0);
+        std::fill(state.begin(), state.end(), scalar_t(0));
+        for (int64_t t = 0; t < length; ++t) {
+          const scalar_t dt = scalar_t(1) / (t + 1);
+          scalar_t input_val_dt[block];
+          scalar_t cumsum_fwd[block];
+          scalar_t cumsum_bwd[block];
+          for (int64_t i = 0; i < block; ++i) {
+            input_val_dt[i] = i < nb ? input_a[t][b0 + i] * dt : scalar_t(0);
+            cumsum_fwd[i] = 0;
+            cumsum_bwd[i] = 0;
+          }
+          for (int64_t n = 0; n < N; ++n) {
+            const scalar_t s = sqrt_scale[n];
+            const scalar_t a = dt / 2 * (n + 1);
+            const scalar_t inv = scalar_t(1) / (1 + a);
+            scalar_t* x = state.data() + n * block;
+            for (int64_t i = 0; i < block; ++i) {
+              const scalar_t out_fwd = x[i] - dt / 2 * cumsum_fwd[i] * s - a * x[i] + input_val_dt[i] * s;
+              cumsum_fwd[i] += x[i] * s;
+              const scalar_t y = (out_fwd - dt / 2 * cumsum_bwd[i] * s) * inv;
+              x[i] = y;
+              cumsum_bwd[i] += y * s;
+            }
+          }
+          for (int64_t i = 0; i < nb; ++i) {
+            for (int64_t n = 0; n < N; ++n) {
+              mem_a[t][b0 + i][n] = state[n * block + i];
+            }
+          }
+        }
+      }
+    });
+  });
+  return mem;
+}
+
 }  // legs
@@ -2,7 +2,7 @@ from setuptools import setup
 from torch.utils.cpp_extension import CppExtension, BuildExtension
 
 ext_modules = []
-extension = CppExtension('hippo', ['hippo.cpp', 'hippolegs.cpp', 'hippolegt.cpp'], extra_compile_args=['-march=native'])
+extension = CppExtension('hippo', ['hippo.cpp', 'hippolegs.cpp', 'hippolegt.cpp', 'hippocell.cpp'], extra_compile_args=['-march=native', '-fopenmp-simd'])
 ext_modules.append(extension)
 
 setup(
@@ -2,6 +2,7 @@ import os
 dir_path = os.path.dirname(os.path.abspath(__file__))
 
 import random
+from functools import partial
 
 import torch
 from torch import nn
@@ -13,6 +14,10 @@ from . import utils
 from .tasks import BinaryClassification, MulticlassClassification, MSERegression
 
 
+# Prepared datasets by configuration (its yaml), built once and shared by the trials of parallel_runner
+dataset_cache = {}
+
+
 class DatasetBase():
     registry = {}
 
@@ -30,14 +35,61 @@ class DatasetBase():
     def prepare_data(self):
         raise NotImplementedError
 
+    def share_data(self):
+        """ With dataset_cfg.shared ('shm' or 'mmap'), moves the tensors of the splits to shared memory or memory-mapped files,
+        which DataLoader workers and concurrent trials then read from the same pages instead of private copies (see utils.share_datasets)
+        """
+        mode = self.dataset_cfg.get('shared', None)
+        if mode:
+            self.train, self.val, self.test = utils.share_datasets([self.train, self.val, self.test], mode,
+                                                                   directory=self.dataset_cfg.get('shared_dir', None))
+
+    def stream_splits(self, make_stream, samples, test_samples, ratio=0.9):
+        """ Train/val/test splits of a synthetic task generated on the fly (utils.StreamDataset), from distinct seeds
+
+        make_stream: (samples, seed) -> StreamDataset
+        """
+        seed = self.dataset_cfg.get('seed', 0)
+        train_len = int(samples * ratio)
+        self.train = make_stream(train_len, seed=(seed, 0))
+        self.val = make_stream(samples - train_len, seed=(seed, 1))
+        self.test = make_stream(test_samples, seed=(seed, 2))
+
     def split_train_val(self, ratio=0.9):
         train_len = int(len(self.train) * ratio)
         self.train, self.val = torch.utils.data.random_split(self.train, (train_len, len(self.train) - train_len))
 
-    def prepare_dataloader(self, batch_size, **kwargs):
-        self.train_loader = torch.utils.data.DataLoader(self.train, batch_size=batch_size, shuffle=True, **kwargs)
-        self.val_loader = torch.utils.data.DataLoader(self.val, batch_size=batch_size, shuffle=False, **kwargs)
-        self.test_loader = torch.utils.data.DataLoader(self.test, batch_size=batch_size, shuffle=False, **kwargs)
+    def prepare_dataloader(self, batch_size, num_replicas=1, rank=0, **kwargs):
+        """ With num_replicas > 1 (data-parallel training), every split is sharded across the ranks with a DistributedSampler,
+        and batch_size is the per-rank batch size. The splits must then be identical on every rank.
+        """
+        if isinstance(self.train, utils.StreamDataset):
+            # The streams batch themselves, and shard their batches across the ranks
+            for split in [self.train, self.val, self.test]:
+                split.batch_size = batch_size
+                split.shard(rank, num_replicas)
+            self.train_loader = utils.EpochLoader(torch.utils.data.DataLoader(self.train, batch_size=None, **kwargs))
+            self.val_loader = torch.utils.data.DataLoader(self.val, batch_size=None, **kwargs)
+            self.test_loader = torch.utils.data.DataLoader(self.test, batch_size=None, **kwargs)
+            return
+        splits = [(self.train, True), (self.val, False), (self.test, False)]
+        if num_replicas > 1:
+            from torch.utils.data.distributed import DistributedSampler
+            samplers = [DistributedSampler(split, num_replicas=num_replicas, rank=rank, shuffle=shuffle) for split, shuffle in splits]
+        else:
+            samplers = [torch.utils.data.RandomSampler(split) if shuffle else torch.utils.data.SequentialSampler(split)
+                        for split, shuffle in splits]
+        if getattr(self.train, 'batched', False):
+            # Batched datasets (e.g. utils.ByteImageDataset) are indexed by the whole batch, which is a single gather:
+            # worker processes would only add the cost of sending the batches back
+            kwargs = {**kwargs, 'num_workers': 0}
+            self.train_loader, self.val_loader, self.test_loader = [
+                torch.utils.data.DataLoader(split, batch_size=None, sampler=utils.EpochBatchSampler(sampler, batch_size, drop_last=False), **kwargs)
+                for (split, _), sampler in zip(splits, samplers)]
+            return
+        self.train_loader, self.val_loader, self.test_loader = [
+            torch.utils.data.DataLoader(split, batch_size=batch_size, sampler=sampler, **kwargs)
+            for (split, _), sampler in zip(splits, samplers)]
 
     def __str__(self):
         return self.name if hasattr(self, 'name') else self.__name__
@@ -65,7 +117,10 @@ class MNIST(DatasetBase, MulticlassClassification):
     N = 784
 
     def prepare_data(self):        
-        
+        if self.dataset_cfg.get('cached', False):
+            self.prepare_cached_data()
+            return
+
         # transform_list = [transforms.ToTensor(),
         #                   transforms.Lambda(lambda x: x.view(self.input_size, self.N).t())]  # (N, input_size)
         transform_list = [transforms.ToTensor(), CustomTransform(self.input_size, self.N)]  # (N, input_size)
@@ -87,6 +142,22 @@ class MNIST(DatasetBase, MulticlassClassification):
         self.test = datasets.MNIST(f'{self.path}/{self.name}', train=False, transform=transform)
         self.split_train_val()
 
+    def prepare_cached_data(self):
+        """ The splits converted once to uint8 (N, 784) tensors, with the permutation already applied, and memory-mapped
+        (see utils.ByteImageDataset). Same samples and train/val split as the transform pipeline, without per-sample work.
+        """
+        permutation = utils.bitreversal_permutation(self.N) if self.dataset_cfg.permute else None
+        suffix = '_permuted' if self.dataset_cfg.permute else ''
+        splits = []
+        for train in [True, False]:
+            mnist = datasets.MNIST(f'{self.path}/{self.name}', train=train, download=True)
+            paths = utils.cache_byte_images(f"{self.path}/{self.name}/cache/{'train' if train else 'test'}{suffix}",
+                                            mnist.data, mnist.targets, permutation)
+            splits.append(utils.ByteImageDataset(paths))
+        self.train, self.test = splits
+        self.split_train_val()
+        self.train, self.val = [split.dataset.subset(split.indices) for split in [self.train, self.val]]
+
     def __str__(self):
         return f"{'p' if self.dataset_cfg.permute else 's'}{self.name}"
 
@@ -103,9 +174,15 @@ class Copying(DatasetBase, MulticlassClassification):
 
     def prepare_data(self):
         cfg = self.dataset_cfg
-        self.train = copying.copying_static_dataset(cfg.L, cfg.M, cfg.A, cfg.variable, cfg.samples)
-        self.test = copying.copying_static_dataset(cfg.L, cfg.M, cfg.A, cfg.variable, cfg.test_samples)
+        if cfg.get('stream', False):
+            make_stream = partial(copying.copying_stream_dataset, cfg.L, cfg.M, cfg.A, cfg.variable, one_hot=not cfg.get('tokens', False))
+            self.stream_splits(make_stream, cfg.samples, cfg.test_samples)
+            return
+        one_hot = not cfg.get('tokens', False)
+        self.train = copying.copying_static_dataset(cfg.L, cfg.M, cfg.A, cfg.variable, cfg.samples, one_hot=one_hot)
+        self.test = copying.copying_static_dataset(cfg.L, cfg.M, cfg.A, cfg.variable, cfg.test_samples, one_hot=one_hot)
         self.split_train_val()
+        self.share_data()
 
     def __str__(self):
         return f"{self.name}{self.dataset_cfg.L}{'v' if self.dataset_cfg.variable else ''}"
@@ -123,9 +200,13 @@ class Adding(DatasetBase, MSERegression):
 
     def prepare_data(self):
         cfg = self.dataset_cfg
+        if cfg.get('stream', False):
+            self.stream_splits(partial(adding.adding_stream_dataset, cfg.L), cfg.samples, cfg.test_samples)
+            return
         self.train = adding.adding_static_dataset(cfg.L, cfg.samples)
         self.test = adding.adding_static_dataset(cfg.L, cfg.test_samples)
         self.split_train_val()
+        self.share_data()
 
     def __str__(self):
         return f"{self.name}{self.dataset_cfg.L}"
@@ -196,7 +277,8 @@ class IMDB(DatasetBase, BinaryClassification):
         TEXT.build_vocab(self.train, max_size=self.input_size - 2)  # Need 2 extra for <unk> and <pad>
         LABEL.build_vocab(self.train)
 
-    def prepare_dataloader(self, batch_size, **kwargs):
+    def prepare_dataloader(self, batch_size, num_replicas=1, rank=0, **kwargs):
+        assert num_replicas == 1, "IMDB: the bucket iterators do not support data-parallel training"
         from torchtext import data
         self.train_loader, self.val_loader, self.test_loader = data.BucketIterator.splits(
             (self.train, self.val, self.test),
@@ -253,3 +335,4 @@ class CharacterTrajectories(DatasetBase, MulticlassClassification):
         self.val   = val_dataset
         self.test  = test_dataset
         assert num_classes == self.output_size, f"Output size should be {num_classes}"
+        self.share_data()
@@ -3,17 +3,20 @@ import torch.nn as nn
 import torch.nn.functional as F
 # from torch.utils.data.dataset import IterableDataset
 import numpy as np
+from functools import partial
 
+from .utils import StreamDataset
 
-def torch_adding_data(L, batch_shape=()):
+
+def torch_adding_data(L, batch_shape=(), generator=None):
     assert L >= 2
     mid = L//2
-    idx0 = torch.randint(low=0, high=mid, size=batch_shape)
-    idx1 = torch.randint(low=0, high=L-mid, size=batch_shape)
+    idx0 = torch.randint(low=0, high=mid, size=batch_shape, generator=generator)
+    idx1 = torch.randint(low=0, high=L-mid, size=batch_shape, generator=generator)
 
     idx = torch.cat((F.one_hot(idx0, mid), F.one_hot(idx1, L-mid)), dim=-1).float() # (batch_shape, L)
     unif = torch.empty(batch_shape+(L,))
-    unif.uniform_(0., 1.)
+    unif.uniform_(0., 1., generator=generator)
 
     x = torch.stack((unif, idx), dim=-1) # (batch_shape, L, 2)
     y = torch.sum(unif*idx, dim=-1, keepdim=True) # (batch_shape, 1)
@@ -26,3 +29,7 @@ def adding_static_dataset(L, samples):
     ds = torch.utils.data.TensorDataset(all_x, all_y)
     return ds
 
+def adding_stream_dataset(L, samples, seed=0):
+    """ The same task generated batch by batch on demand, see utils.StreamDataset """
+    return StreamDataset(partial(torch_adding_data, L), samples, seed=seed)
+
@@ -3,6 +3,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 # from torch.utils.data.dataset import IterableDataset
 import numpy as np
+from functools import partial
+
+from .utils import StreamDataset
 
 
 def np_copying_data(L, M, A, batch_shape=()):
@@ -17,31 +20,47 @@ def np_copying_data(L, M, A, batch_shape=()):
     y = torch.tensor(y_, dtype=torch.int64)
     return x, y
 
-def torch_copying_data(L, M, A, variable=False, batch_shape=()):
-    tokens = torch.randint(low=1, high=A-1, size=batch_shape+(M,))
+def random_subsets(n, k, batch_shape=(), generator=None):
+    """ Indices (batch_shape, k) of uniformly random k-subsets of range(n), without replacement
+
+    Vectorized Floyd's algorithm: k steps over the whole batch, so O(k^2) per sample instead of the O(n) of a permutation.
+    Step j draws t uniformly in [0, j]; t is taken unless it was already drawn, in which case j (never drawn before) is.
+    """
+    batch = int(np.prod(batch_shape))
+    inds = torch.empty(batch, k, dtype=torch.long)
+    for i, j in enumerate(range(n - k, n)):
+        t = (torch.rand(batch, generator=generator) * (j + 1)).long()
+        drawn = (inds[:, :i] == t.unsqueeze(-1)).any(dim=-1)
+        inds[:, i] = torch.where(drawn, torch.full_like(t, j), t)
+    return inds.view(batch_shape+(k,))
+
+def token_dtype(A):
+    """ Smallest integer type holding the token ids of an alphabet of size A """
+    return torch.int16 if A <= torch.iinfo(torch.int16).max + 1 else torch.int64
+
+def torch_copying_data(L, M, A, variable=False, batch_shape=(), generator=None, one_hot=True):
+    """ Returns inputs x (batch_shape, L+2M, A) one-hot, or (batch_shape, L+2M) token ids of type token_dtype(A) with one_hot=False, and targets y (batch_shape, M) """
+    tokens = torch.randint(low=1, high=A-1, size=batch_shape+(M,), generator=generator)
     if variable:
-        total_batch = np.prod(batch_shape)
-        inds = torch.stack([
-            torch.randperm(L+M)[:M]
-            for _ in range(total_batch)
-            ], 0)
-        inds = inds.reshape(batch_shape+(M,))
-        inds, _ = inds.sort()
+        inds, _ = random_subsets(L+M, M, batch_shape, generator).sort()
     else:
         inds = torch.arange(M).repeat(batch_shape+(1,))
-    zeros_x = torch.zeros(batch_shape+(M+L,), dtype=torch.long)
-    zeros_x.scatter_(-1, inds, tokens)
-    markers = (A-1) * torch.ones(batch_shape+(M,), dtype=torch.long)
-
-    x_ = torch.cat([zeros_x, markers], dim=-1)
-    y_ = torch.cat([tokens], dim=-1)
-    x = F.one_hot(x_, A).float()
+    # Tokens scattered among M+L blanks, followed by M markers, written in place
+    x_ = torch.zeros(batch_shape+(L+2*M,), dtype=torch.long)
+    x_[..., :M+L].scatter_(-1, inds, tokens)
+    x_[..., M+L:] = A-1
+    y_ = tokens
+    x = F.one_hot(x_, A).float() if one_hot else x_.to(token_dtype(A))
     y = y_
     return x, y
 
 
-def copying_static_dataset(L, M, A, variable, samples):
-    all_x, all_y = torch_copying_data(L, M, A, variable, batch_shape=(samples,))
+def copying_static_dataset(L, M, A, variable, samples, one_hot=True):
+    all_x, all_y = torch_copying_data(L, M, A, variable, batch_shape=(samples,), one_hot=one_hot)
     print("Constructing Copying dataset of shape", all_x.shape)
     ds = torch.utils.data.TensorDataset(all_x, all_y)
     return ds
+
+def copying_stream_dataset(L, M, A, variable, samples, seed=0, one_hot=True):
+    """ The same task generated batch by batch on demand, see utils.StreamDataset """
+    return StreamDataset(partial(torch_copying_data, L, M, A, variable, one_hot=one_hot), samples, seed=seed)
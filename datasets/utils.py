@@ -1,4 +1,7 @@
+import hashlib
 import math
+import os
+import tempfile
 import numpy as np
 
 import torch
@@ -19,6 +22,191 @@ def bitreversal_permutation(n):
     return np.extract(perm < n, perm)
 
 
+# Synthetic tasks generated on the fly
+
+class StreamDataset(torch.utils.data.IterableDataset):
+    """ A synthetic task whose samples are generated on demand, one batch at a time, in constant memory
+
+    generate(batch_shape=(size,), generator=g) returns a batch from the torch.Generator g.
+    Batch i of an epoch is drawn from a generator seeded by (seed, epoch, i), so the epochs are deterministic
+    whatever the number of DataLoader workers (each generates its share of the batches) and of data-parallel ranks (see shard).
+    Iterate it with DataLoader(batch_size=None); the batch size is set by DatasetBase.prepare_dataloader.
+    """
+    def __init__(self, generate, samples, seed=0, batch_size=1):
+        self.generate = generate
+        self.samples = samples
+        self.seed = seed
+        self.batch_size = batch_size
+        self.epoch = 0
+        self.rank, self.num_replicas = 0, 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard(self, rank, num_replicas):
+        self.rank, self.num_replicas = rank, num_replicas
+
+    def batches(self):
+        """ Indices of the batches of this rank """
+        nbatches = (self.samples + self.batch_size - 1) // self.batch_size
+        return range(self.rank, nbatches, self.num_replicas)
+
+    def __len__(self):
+        return len(self.batches())
+
+    def __iter__(self):
+        batches = self.batches()
+        worker = torch.utils.data.get_worker_info()
+        if worker is not None:
+            batches = batches[worker.id::worker.num_workers]
+        for i in batches:
+            size = min(self.batch_size, self.samples - i * self.batch_size)
+            generator = torch.Generator().manual_seed(hash((self.seed, self.epoch, i)) % (1 << 63))
+            yield self.generate(batch_shape=(size,), generator=generator)
+
+class EpochLoader:
+    """ Wraps the loader of a StreamDataset to draw new samples at every epoch
+
+    The epoch is set on the dataset of the main process, which the workers copy when an iteration starts.
+    Persistent workers keep their copy from the first epoch, and are therefore not supported.
+    """
+    def __init__(self, loader):
+        assert not getattr(loader, 'persistent_workers', False), "EpochLoader: persistent workers would repeat the first epoch"
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        # Workers receive a copy of the dataset when the iteration starts, so they see the new epoch
+        self.dataset.set_epoch(self.epoch)
+        self.epoch += 1
+        return iter(self.loader)
+
+
+# Sharing datasets between processes
+
+class MemmapTensorDataset(torch.utils.data.TensorDataset):
+    """ TensorDataset over memory-mapped .npy files
+
+    It is pickled by path, so that every process (DataLoader workers, spawned ranks, concurrent trials) maps the same pages
+    of the page cache instead of receiving a copy. The mappings are copy-on-write: the files are never modified.
+    """
+    def __init__(self, paths):
+        self.paths = paths
+        super().__init__(*[torch.from_numpy(np.load(path, mmap_mode='c')) for path in paths])
+
+    def __getstate__(self):
+        return {'paths': self.paths}
+
+    def __setstate__(self, state):
+        self.__init__(state['paths'])
+
+def save_npy(path, x):
+    """ Writes the array x to the .npy file path, under a temporary name first: several processes may write it at once """
+    tmp = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp, np.ascontiguousarray(x))
+    os.replace(tmp, path)
+
+def share_datasets(datasets, mode, directory=None):
+    """ Moves the tensors of TensorDatasets (or of their Subsets, e.g. from random_split) out of the private memory of the process
+
+    mode: 'shm' for shared memory (share_memory_), or 'mmap' for memory-mapped .npy files in directory
+        (default: hippo_data in the temporary directory). The files are named by a hash of their contents, so that
+        processes building the same data (e.g. the ranks of a data-parallel run, or later runs) reuse the same files.
+        They are kept as a cache: delete the directory to reclaim the space.
+    Returns the datasets in the same order. Subsets of the same dataset keep sharing it.
+    """
+    assert mode in ['shm', 'mmap'], f"share_datasets: mode {mode} not supported"
+    shared = {} # id of a TensorDataset -> its shared version
+    if mode == 'mmap':
+        directory = directory or os.path.join(tempfile.gettempdir(), 'hippo_data')
+        os.makedirs(directory, exist_ok=True)
+
+    def share(ds):
+        if isinstance(ds, torch.utils.data.Subset):
+            ds.dataset = share(ds.dataset)
+            return ds
+        assert isinstance(ds, torch.utils.data.TensorDataset), f"share_datasets: {type(ds).__name__} is not a TensorDataset"
+        if id(ds) not in shared:
+            if mode == 'shm':
+                for tensor in ds.tensors:
+                    tensor.share_memory_()
+                shared[id(ds)] = ds
+            else:
+                paths = []
+                for tensor in ds.tensors:
+                    x = tensor.contiguous().numpy()
+                    digest = hashlib.blake2b(f'{x.dtype}{x.shape}'.encode(), digest_size=16)
+                    digest.update(memoryview(x).cast('B'))
+                    paths.append(os.path.join(directory, f'{digest.hexdigest()}.npy'))
+                    if not os.path.exists(paths[-1]):
+                        save_npy(paths[-1], x)
+                shared[id(ds)] = MemmapTensorDataset(paths)
+        return shared[id(ds)]
+
+    return [share(ds) for ds in datasets]
+
+
+# Image datasets cached as uint8 tensors
+
+def cache_byte_images(path, images, targets, permutation=None):
+    """ Writes uint8 images (N, H, W), flattened to (N, H*W) and with the permutation of the pixels applied,
+    and their targets to the .npy files path_x.npy and path_y.npy, unless these exist. Returns the two paths.
+    """
+    paths = [f'{path}_x.npy', f'{path}_y.npy']
+    if not all(os.path.exists(p) for p in paths):
+        x = images.reshape(len(images), -1)
+        if permutation is not None:
+            x = x[:, permutation]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for p, tensor in zip(paths, [x, targets]):
+            save_npy(p, tensor.numpy())
+    return paths
+
+class ByteImageDataset(MemmapTensorDataset):
+    """ Memory-mapped uint8 images (N, length) and targets (N,), see cache_byte_images
+
+    Samples are (length, 1) float sequences in [0, 1], with the values of transforms.ToTensor.
+    The dataset is batched: indexed with a list of indices, it gathers and converts the whole batch at once,
+    which DatasetBase.prepare_dataloader does through a BatchSampler. indices restricts it to a subset of the samples.
+    """
+    batched = True
+
+    def __init__(self, paths, indices=None):
+        super().__init__(paths)
+        self.indices = None if indices is None else torch.as_tensor(indices, dtype=torch.long)
+
+    def __len__(self):
+        return len(self.tensors[0]) if self.indices is None else len(self.indices)
+
+    def __getitem__(self, i):
+        if self.indices is not None:
+            i = self.indices[i]
+        x, y = self.tensors[0][i], self.tensors[1][i]
+        return x.float().div(255).unsqueeze(-1), y
+
+    def subset(self, indices):
+        return ByteImageDataset(self.paths, indices)
+
+    def __getstate__(self):
+        return {'paths': self.paths, 'indices': self.indices}
+
+    def __setstate__(self, state):
+        self.__init__(state['paths'], state['indices'])
+
+class EpochBatchSampler(torch.utils.data.BatchSampler):
+    """ BatchSampler that forwards set_epoch to its sampler, e.g. a DistributedSampler, which shuffles by epoch
+
+    Lightning calls set_epoch on the sampler of the training loader, which for a batched dataset is this wrapper.
+    """
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+
 # For language modeling
 # Adapted from https://github.com/salesforce/awd-lstm-lm/blob/master/utils.py
 
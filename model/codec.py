@@ -0,0 +1,212 @@
+""" Lossy compression of long multichannel signals into HiPPO coefficients.
+
+A signal f of shape (T, C) is cut into segments of `segment` steps. Each segment of each channel is encoded by the
+final coefficients (order N) of a HiPPO memory restarted at the beginning of the segment:
+  legs - HiPPO_LegS, whose uniform measure weights the whole segment equally
+  legt - HiPPO_LegT with a window of one segment
+Both recurrences are linear, so encoding a segment is a single product with a fixed (segment, N) matrix,
+and decoding, which evaluates the Legendre series at the steps of the segment (see HiPPO_LegS.reconstruct),
+is a product with the (N, segment) matrix of the basis functions evaluated with Clenshaw's recurrence.
+
+File layout (little endian), in the style of state_io:
+  header: see HEADER below
+  chunks: (segments, C, N) coefficients of chunk_segments consecutive segments each, float32 or float16
+  index:  (nchunks,) int64 byte offsets of the chunks
+Every buffer starts at a multiple of ALIGN bytes, so that decoding reads the chunks it needs from a memory map.
+"""
+
+import mmap
+import struct
+from functools import lru_cache
+
+import torch
+
+from model.hippo import HiPPO_LegS, HiPPO_LegT
+from model.state_io import padding, write_tensor, read_tensor
+
+
+MAGIC = b'HIPPOCD\0'
+VERSION = 1
+# magic, version, measure, coefficient dtype, length T, channels C, order N, segment, chunk_segments, nchunks, index offset
+HEADER = struct.Struct('<8sIII4xQQQQQQQ')
+
+measure_codes = {'legs': 0, 'legt': 1}
+code_measures = {v: k for k, v in measure_codes.items()}
+dtype_codes = {torch.float32: 0, torch.float16: 1}
+code_dtypes = {v: k for k, v in dtype_codes.items()}
+
+
+def hippo_module(measure, order, length):
+    """ HiPPO module encoding segments of the given length
+
+    Not cached: HiPPO_LegS holds (length, order, order) transition buffers, only the matrices derived from it are kept.
+    """
+    if measure == 'legs':
+        return HiPPO_LegS(order, max_length=length)
+    if measure == 'legt':
+        return HiPPO_LegT(order, dt=1./length)
+    assert False, f"codec: measure {measure} not supported"
+
+@lru_cache(maxsize=16)
+def encoding_matrix(measure, order, length):
+    """ E (length, order) such that the final coefficients of a segment f (length,) are f @ E """
+    module = hippo_module(measure, order, length)
+    if measure == 'legt':
+        return module.kernel(length).flip(0) # c[L-1] = sum_j K[L-1-j] f[j]
+    # The memory is linear in the inputs: row j is the final memory of the unit impulse at step j.
+    # Impulses are unrolled in blocks, to bound the (length, block, order) intermediate memories
+    E = []
+    block = max(1, 2**22 // (length * order))
+    with torch.no_grad():
+        for j in range(0, length, block):
+            impulses = torch.eye(length)[:, j:j+block]
+            E.append(module(impulses)[-1])
+    return torch.cat(E, dim=0)
+
+def positions(measure, length):
+    """ Points in [0, 1] of the steps of a segment, in the convention of the reconstruct() of the module """
+    if measure == 'legs':
+        return torch.linspace(0.0, 1.0, length)
+    return torch.arange(length) / length
+
+
+@lru_cache(maxsize=16)
+def decoding_matrix(measure, order, length):
+    """ D (order, length) such that the reconstruction of a segment from coefficients c (order,) is c @ D """
+    module = hippo_module(measure, order, length)
+    return module.reconstruct(torch.eye(order), vals=positions(measure, length))
+
+def encode_segments(f, measure, order):
+    """ f: (S, length, C) segments -> (S, C, order) coefficients """
+    E = encoding_matrix(measure, order, f.shape[1])
+    return f.transpose(1, 2) @ E
+
+def decode_segments(c, measure, length):
+    """ c: (S, C, order) coefficients -> (S, length, C) reconstructions """
+    D = decoding_matrix(measure, c.shape[-1], length)
+    return (c @ D).transpose(1, 2)
+
+
+def encode(f, path, order=64, segment=1024, measure='legs', dtype=torch.float16, chunk_segments=64):
+    """ Compress a signal into a codec file
+
+    f: (T, C) array or tensor
+    order: number of coefficients per segment and channel, i.e. the compression ratio is segment / order
+    segment: number of steps encoded by each coefficient vector
+    dtype: storage type of the coefficients, float32 or float16
+    chunk_segments: number of segments per chunk, the granularity of reads
+    Returns the number of bytes written.
+    """
+    f = torch.as_tensor(f, dtype=torch.float32)
+    if f.dim() == 1:
+        f = f.unsqueeze(-1)
+    T, C = f.shape
+    nsegments = (T + segment - 1) // segment
+    nchunks = (nsegments + chunk_segments - 1) // chunk_segments
+    offsets = []
+    with open(path, 'wb') as file:
+        file.write(b'\0' * HEADER.size) # written once the index offset is known
+        offset = HEADER.size
+        for start in range(0, nsegments, chunk_segments):
+            stop = min(start + chunk_segments, nsegments)
+            x = f[start*segment:stop*segment]
+            full = x.shape[0] // segment
+            c = encode_segments(x[:full*segment].view(full, segment, C), measure, order)
+            if full < stop - start: # the shorter last segment of the signal
+                c = torch.cat([c, encode_segments(x[full*segment:].unsqueeze(0), measure, order)], dim=0)
+            offsets.append(offset + padding(offset))
+            offset = write_tensor(file, offset, c.to(dtype))
+        index_offset = offset + padding(offset)
+        offset = write_tensor(file, offset, torch.tensor(offsets, dtype=torch.int64))
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, measure_codes[measure], dtype_codes[dtype],
+                               T, C, order, segment, chunk_segments, nchunks, index_offset))
+    return offset
+
+
+class Decoder:
+    """ Reconstructs arbitrary time ranges of a codec file, reading only the chunks that cover them """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            # Copy-on-write mapping: writable for torch.frombuffer, but never modifies the file
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, measure, dtype, T, C, N, segment, chunk_segments, nchunks, index_offset = HEADER.unpack_from(self.buffer, 0)
+        assert magic == MAGIC, "codec: not a HiPPO codec file"
+        assert version == VERSION, f"codec: unsupported version {version}"
+        self.measure = code_measures[measure]
+        self.dtype = code_dtypes[dtype]
+        self.length, self.channels, self.order = T, C, N
+        self.segment, self.chunk_segments = segment, chunk_segments
+        self.nsegments = (T + segment - 1) // segment
+        self.index, _ = read_tensor(self.buffer, index_offset, torch.int64, (nchunks,))
+
+    def __len__(self):
+        return self.length
+
+    def coefficients(self, start, stop):
+        """ (stop-start, C, N) float32 coefficients of segments start to stop """
+        cs = []
+        for chunk in range(start // self.chunk_segments, (stop - 1) // self.chunk_segments + 1):
+            first = chunk * self.chunk_segments
+            count = min(self.chunk_segments, self.nsegments - first)
+            c, _ = read_tensor(self.buffer, int(self.index[chunk]), self.dtype, (count, self.channels, self.order))
+            cs.append(c[max(start - first, 0):stop - first].float())
+        return torch.cat(cs, dim=0)
+
+    def decode(self, start=0, stop=None):
+        """ Reconstruction (stop-start, C) of the steps start to stop of the signal """
+        stop = self.length if stop is None else min(stop, self.length)
+        if stop <= start:
+            return torch.empty(0, self.channels)
+        first, last = start // self.segment, (stop - 1) // self.segment + 1
+        c = self.coefficients(first, last)
+        # Full segments share the same evaluation points, and are reconstructed together
+        full = min(last, self.length // self.segment) - first
+        f = [decode_segments(c[:full], self.measure, self.segment).reshape(-1, self.channels)]
+        if full < last - first:
+            f.append(decode_segments(c[full:], self.measure, self.length - (last - 1) * self.segment)[0])
+        f = torch.cat(f, dim=0)
+        return f[start - first*self.segment:stop - first*self.segment]
+
+
+def decode(path, start=0, stop=None):
+    return Decoder(path).decode(start, stop)
+
+
+
+### Benchmark
+
+def benchmark(T=2**20, C=8, segment=1024, path='/tmp/hippo_codec.bin'):
+    import time
+    torch.manual_seed(0)
+    # Smooth signals: random sinusoids with a little noise
+    t = torch.arange(T, dtype=torch.float64).unsqueeze(-1) / segment
+    freqs = torch.rand(16, C, dtype=torch.float64) * 4
+    phases = torch.rand(16, C, dtype=torch.float64) * 6.28
+    f = torch.sin(t.unsqueeze(1) * freqs * 6.28 + phases).sum(dim=1).float() / 4
+    f = f + 0.01 * torch.randn(T, C)
+    nbytes = f.numel() * 4
+    for measure in ['legs', 'legt']:
+        for order in [16, 32, 64, 128]:
+            for dtype in [torch.float32, torch.float16]:
+                encoding_matrix(measure, order, segment) # computed once per configuration
+                start = time.perf_counter()
+                size = encode(f, path, order=order, segment=segment, measure=measure, dtype=dtype)
+                encode_time = time.perf_counter() - start
+                start = time.perf_counter()
+                f_ = decode(path)
+                decode_time = time.perf_counter() - start
+                rmse = (f - f_).pow(2).mean().sqrt().item() / f.std().item()
+                print(f"{measure} order {order:>3} {str(dtype):>13}: encode {nbytes/encode_time/1e6:7.1f} MB/s, "
+                      f"decode {nbytes/decode_time/1e6:7.1f} MB/s, ratio {nbytes/size:6.1f}, relative rmse {rmse:.2e}")
+    decoder = Decoder(path)
+    start = time.perf_counter()
+    for _ in range(100):
+        i = torch.randint(0, T - 1000, ()).item()
+        decoder.decode(i, i + 1000)
+    print(f"random 1000-step reads: {(time.perf_counter() - start) / 100 * 1e3:.2f} ms")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -2,16 +2,20 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as data
+import math
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy import signal
 from scipy import linalg as la
 from scipy import special as ss
-import nengo
 
 from model import unroll
 from model.op import transition
 
+try:
+    import hippo # C++ extension in csrc/
+except ImportError:
+    hippo = None
+
 
 """
 The HiPPO_LegT and HiPPO_LegS modules satisfy the HiPPO interface:
@@ -22,6 +26,8 @@ c[k] can be thought of as representing all of f[:k] via coefficients of a polyno
 The reconstruct() method takes the coefficients and turns each coefficient into a reconstruction of the original input.
 Note that each coefficient c[k] turns into an approximation of the entire input f, so this reconstruction has shape (L, L),
 and the last element of this reconstruction (which has shape (L,)) is the most accurate reconstruction of the original input.
+reconstruct(c, last=True) only computes that last element, and reconstruct(c, vals) evaluates the approximations at arbitrary points;
+the polynomials are evaluated on demand (see legendre_eval), in O(N) per coefficient vector and point.
 
 Both of these two methods construct approximations according to different measures, defined in the HiPPO paper.
 The first one is the "Translated Legendre" (which is up to scaling equal to the LMU matrix),
@@ -29,47 +35,148 @@ and the second one is the "Scaled Legendre".
 Each method comprises an exact recurrence c_k = A_k c_{k-1} + B_k f_k, and an exact reconstruction formula based on the corresponding polynomial family.
 """
 
+def legendre_eval(c, x):
+    """ Evaluates the Legendre series sum_n c[..., n] P_n(x) with Clenshaw's recurrence
+
+    c : (..., N) coefficients
+    x : (Q,) points in [-1, 1]
+    output : (..., Q)
+    Costs O(N Q) per coefficient vector, without materializing the (Q, N) table of the P_n(x).
+    """
+    N = c.shape[-1]
+    x = x.to(c)
+    b1 = c.new_zeros(c.shape[:-1] + x.shape) # b_{k+1}
+    b2 = torch.zeros_like(b1) # b_{k+2}
+    for k in range(N-1, -1, -1):
+        # P_{k+1} = (2k+1)/(k+1) x P_k - k/(k+1) P_{k-1}, so b_k = c_k + (2k+1)/(k+1) x b_{k+1} - (k+1)/(k+2) b_{k+2}
+        b = c[..., k:k+1] + (2*k+1)/(k+1) * x * b1 - (k+1)/(k+2) * b2
+        b1, b2 = b, b1
+    return b1 # b_0, since P_0 = 1 and P_1 = x
+
+
 class HiPPO_LegT(nn.Module):
     def __init__(self, N, dt=1.0, discretization='bilinear'):
         """
         N: the order of the HiPPO projection
         dt: discretization step size - should be roughly inverse to the length of the sequence
+          A sequence of K step sizes makes a bank of K windows, whose memories are unrolled together:
+          the transitions are stacked into A (K, N, N) and B (K, N), and the coefficients have shape (..., K, N)
         """
         super().__init__()
         self.N = N
+        self.bank = np.ndim(dt) > 0
+        dts = [float(d) for d in dt] if self.bank else [dt]
+        self.dt = dts if self.bank else dt
+        self.nscales = len(dts)
         A, B = transition('lmu', N)
         C = np.ones((1, N))
         D = np.zeros((1,))
         # dt, discretization options
-        A, B, _, _, _ = signal.cont2discrete((A, B, C, D), dt=dt, method=discretization)
+        dAs, dBs = [], []
+        for dt_ in dts:
+            dA, dB, _, _, _ = signal.cont2discrete((A, B, C, D), dt=dt_, method=discretization)
+            dAs.append(dA)
+            dBs.append(dB.squeeze(-1))
+        A, B = np.stack(dAs), np.stack(dBs)
+        if not self.bank:
+            A, B = A[0], B[0]
+
+        self.register_buffer('A', torch.Tensor(A)) # (N, N), or (K, N, N) for a bank
+        self.register_buffer('B', torch.Tensor(B)) # (N,), or (K, N)
 
-        B = B.squeeze(-1)
+        # vals = np.linspace(0.0, 1.0, 1./dt)
+        # Default reconstruction points: one per step of the (longest) window
+        self.register_buffer('vals', torch.Tensor(np.arange(0.0, 1.0, min(dts))), persistent=False)
 
-        self.register_buffer('A', torch.Tensor(A)) # (N, N)
-        self.register_buffer('B', torch.Tensor(B)) # (N,)
+    engines = ['sequential', 'scan', 'fft']
 
-        # vals = np.linspace(0.0, 1.0, 1./dt)
-        vals = np.arange(0.0, 1.0, dt)
-        self.eval_matrix = torch.Tensor(ss.eval_legendre(np.arange(N)[:, None], 1 - 2 * vals).T)
+    def select_engine(self, inputs):
+        """ Cheapest engine for inputs of shape (length, ...)
 
-    def forward(self, inputs):
+        The loop for short sequences, otherwise the FFT convolution. On CPU, the loop of (batch, N) x (N, N) products
+        is also faster than the O(batch N L log L) convolution for large batches.
+        """
+        L = inputs.shape[0]
+        batch = inputs[0].numel()
+        if L <= 8 or (inputs.device.type == 'cpu' and batch * self.nscales * self.N > 4096):
+            return 'sequential'
+        return 'fft'
+
+    def forward(self, inputs, fast=False, engine=None):
         """
         inputs : (length, ...)
-        output : (length, ..., N) where N is the order of the HiPPO projection
+        output : (length, ..., N) where N is the order of the HiPPO projection, or (length, ..., K, N) for a bank
+        engine : 'sequential' (loop over the sequence), 'scan' (parallel scan) or 'fft' (convolution with the impulse response);
+          chosen by select_engine by default. fast=True is the former name of engine='scan'
         """
+        if engine is None:
+            engine = 'scan' if fast else self.select_engine(inputs)
+        assert engine in self.engines, f"HiPPO_LegT: engine {engine} not supported"
+        if engine == 'fft':
+            return self.convolve(inputs)
+
+        shape = inputs.shape
+        scales = self.A.shape[:-2] # (K,) for a bank
+        inputs = inputs.reshape(shape[0], -1, 1) # the scan expects a single batch dimension
+
+        if engine == 'scan':
+            # The windows of a bank are independent: the scan runs on the block diagonal transition
+            A = torch.block_diag(*self.A) if self.bank else self.A
+            c = unroll.variable_unroll_matrix(A, inputs * self.B.reshape(-1), variable=False)
+        elif self.bank:
+            # Every step is one batched product (K, batch, N) x (K, N, N) for all windows
+            c = inputs.new_zeros(self.nscales, inputs.shape[1], self.N)
+            cs = []
+            for f in inputs:
+                c = torch.baddbmm(self.B.unsqueeze(1) * f.view(1, -1, 1), c, self.A.transpose(-1, -2))
+                cs.append(c)
+            c = torch.stack(cs, dim=0).transpose(1, 2) # (length, batch, K, N)
+        else:
+            c = inputs.new_zeros(inputs.shape[1], self.N)
+            cs = []
+            for f in inputs:
+                c = F.linear(c, self.A) + self.B * f
+                cs.append(c)
+            c = torch.stack(cs, dim=0)
+        return c.reshape(*shape, *scales, self.N)
+
+    def kernel(self, L):
+        """ Returns K (L, N) with K[j] = A^j B, the impulse response of the recurrence, or (L, K, N) for a bank """
+        K = self.B.unsqueeze(-2) # (..., 1, N)
+        P = self.A # A^(len(K))
+        while K.shape[-2] < L:
+            K = torch.cat([K, K @ P.transpose(-1, -2)], dim=-2)
+            P = P @ P
+        return K[..., :L, :].movedim(-2, 0)
+
+    def convolve(self, inputs):
+        """ Same output as forward(), computed as the causal convolution c[k] = sum_j K[k-j] f[j] with FFTs
 
-        inputs = inputs.unsqueeze(-1)
-        u = inputs * self.B # (length, ..., N)
-
-        c = torch.zeros(u.shape[1:])
-        cs = []
-        for f in inputs:
-            c = F.linear(c, self.A) + self.B * f
-            cs.append(c)
-        return torch.stack(cs, dim=0)
-
-    def reconstruct(self, c):
-        return (self.eval_matrix @ c.unsqueeze(-1)).squeeze(-1)
+        inputs : (length, ...)
+        output : (length, ..., N), or (length, ..., K, N) for a bank
+        """
+        L = inputs.shape[0]
+        scales = self.A.shape[:-2]
+        K = self.kernel(L) # (L, N) or (L, K, N)
+        K = K.view(L, *[1]*(inputs.dim()-1), *scales, self.N)
+        # Zero-pad to 2L so that the circular convolution is the linear one
+        # The FFT of the inputs is shared by all the windows of a bank
+        f_ = torch.fft.rfft(inputs.view(*inputs.shape, *[1]*len(scales), 1), n=2*L, dim=0)
+        K_ = torch.fft.rfft(K, n=2*L, dim=0)
+        return torch.fft.irfft(f_ * K_, n=2*L, dim=0)[:L]
+
+    def reconstruct(self, c, vals=None, last=False):
+        """
+        c : (..., N) coefficients, e.g. the (length, ..., N) output of forward()
+        vals : (Q,) points in [0, 1] of the window to evaluate, defaults to one per step
+          For a bank, the points are relative to the window of each scale
+        last : only reconstruct from c[-1]
+        output : (..., Q)
+        """
+        if last:
+            c = c[-1]
+        vals = self.vals if vals is None else torch.as_tensor(vals)
+        return legendre_eval(c, 1 - 2 * vals)
 
 
 
@@ -81,6 +188,9 @@ class HiPPO_LegS(nn.Module):
         """
         super().__init__()
         self.N = N
+        self.measure = measure
+        self.discretization = discretization
+        self.max_length = max_length
         A, B = transition(measure, N)
         B = B.squeeze(-1)
         A_stacked = np.empty((max_length, N, N), dtype=A.dtype)
@@ -100,40 +210,123 @@ class HiPPO_LegS(nn.Module):
             else: # ZOH
                 A_stacked[t - 1] = la.expm(A * (math.log(t + 1) - math.log(t)))
                 B_stacked[t - 1] = la.solve_triangular(A, A_stacked[t - 1] @ B - B, lower=True)
-        self.A_stacked = torch.Tensor(A_stacked) # (max_length, N, N)
-        self.B_stacked = torch.Tensor(B_stacked) # (max_length, N)
+        # Not saved in the state dict, but moved along with the module
+        self.register_buffer('A_stacked', torch.Tensor(A_stacked), persistent=False) # (max_length, N, N)
+        self.register_buffer('B_stacked', torch.Tensor(B_stacked), persistent=False) # (max_length, N)
         # print("B_stacked shape", B_stacked.shape)
 
-        vals = np.linspace(0.0, 1.0, max_length)
-        self.eval_matrix = torch.Tensor((B[:, None] * ss.eval_legendre(np.arange(N)[:, None], 2 * vals - 1)).T)
+        # Default reconstruction points: one per step of the longest sequence
+        self.register_buffer('vals', torch.Tensor(np.linspace(0.0, 1.0, max_length)), persistent=False)
+        self.register_buffer('B', torch.tensor(B, dtype=torch.float), persistent=False)
+
+    engines = ['sequential', 'scan', 'cpp']
+
+    def cpp_supported(self, inputs):
+        """ The C++ kernel implements the bilinear LegS recurrence in O(N) per step, on CPU """
+        return (hippo is not None and self.measure == 'legs' and self.discretization == 'bilinear'
+                and inputs.device.type == 'cpu' and inputs.dtype in [torch.float32, torch.float64] and not inputs.requires_grad)
+
+    def select_engine(self, inputs):
+        """ Cheapest engine for inputs of shape (length, ...)
 
-    def forward(self, inputs, fast=False):
+        The C++ kernel when it applies. Otherwise the parallel scan for long sequences, whose O(N^3) matrix products
+        only pay off on CPU for small N and batches, and the sequential O(batch N^2) loop else.
+        """
+        if self.cpp_supported(inputs):
+            return 'cpp'
+        L = inputs.shape[0]
+        batch = inputs[0].numel()
+        if inputs.device.type != 'cpu': # fewer kernel launches
+            return 'scan' if L >= 64 else 'sequential'
+        return 'scan' if L >= 64 and self.N <= 64 and batch <= 64 else 'sequential'
+
+    def forward(self, inputs, fast=False, engine=None):
         """
         inputs : (length, ...)
         output : (length, ..., N) where N is the order of the HiPPO projection
+        engine : 'sequential', 'scan' (parallel scan) or 'cpp' (C++ kernel, inference on CPU);
+          chosen by select_engine by default. fast=True is the former name of engine='scan'
         """
 
         L = inputs.shape[0]
+        if engine is None:
+            engine = 'scan' if fast else self.select_engine(inputs)
+        assert engine in self.engines, f"HiPPO_LegS: engine {engine} not supported"
+        shape = inputs.shape
+        inputs = inputs.reshape(L, -1) # the scan expects a single batch dimension
+        if engine == 'cpp':
+            assert self.cpp_supported(inputs), "HiPPO_LegS: the C++ kernel requires the bilinear legs measure and CPU inputs without grad"
+            result = hippo.legs_trapezoidal_unroll(inputs.contiguous(), self.N)
+            return result.view(*shape, self.N)
 
         inputs = inputs.unsqueeze(-1)
         u = torch.transpose(inputs, 0, -2)
         u = u * self.B_stacked[:L]
-        u = torch.transpose(u, 0, -2) # (length, ..., N)
+        u = torch.transpose(u, 0, -2) # (length, batch, N)
 
-        if fast:
+        if engine == 'scan':
             result = unroll.variable_unroll_matrix(self.A_stacked[:L], u)
         else:
             result = unroll.variable_unroll_matrix_sequential(self.A_stacked[:L], u)
-        return result
+        return result.view(*shape, self.N)
+
+    def reconstruct(self, c, vals=None, last=False):
+        """
+        c : (..., N) coefficients, e.g. the (length, ..., N) output of forward()
+        vals : (Q,) points in [0, 1] of the history to evaluate, defaults to max_length evenly spaced points
+        last : only reconstruct from c[-1]
+        output : (..., Q)
+        """
+        if last:
+            c = c[-1]
+        vals = self.vals if vals is None else torch.as_tensor(vals)
+        return legendre_eval(c * self.B, 2 * vals - 1)
 
-    def reconstruct(self, c):
-        a = self.eval_matrix @ c.unsqueeze(-1)
-        return a.squeeze(-1)
+
+class VariableMemoryProjection(nn.Module):
+    """ Projects every channel of a sequence onto a HiPPO memory, as preprocessing for the RNN (see Model(preprocess=...))
+
+    All channels and batch elements are unrolled together, with the engine (e.g. parallel scan, FFT convolution or C++ kernel)
+    chosen by HiPPO_LegS.select_engine / HiPPO_LegT.select_engine.
+    """
+    def __init__(self, order=1, measure='legs', dt=None, max_length=1024, discretization='bilinear'):
+        """
+        order: the order N of the HiPPO projection
+        measure: 'legs' (scaled Legendre) or 'legt' (translated Legendre)
+        dt: step size of 'legt', which remembers a window of 1/dt steps; defaults to 1/max_length
+          A sequence of K step sizes projects every channel onto K windows (see HiPPO_LegT), i.e. K * order features
+        max_length: maximum sequence length of 'legs'
+        """
+        super().__init__()
+        self.order = order
+        self.measure = measure
+        if measure == 'legs':
+            self.hippo = HiPPO_LegS(order, max_length=max_length, discretization=discretization)
+        elif measure in ['legt', 'lmu']:
+            self.hippo = HiPPO_LegT(order, dt=1./max_length if dt is None else dt, discretization=discretization)
+        else:
+            assert False, f"VariableMemoryProjection: measure {measure} not supported"
+        self.nscales = getattr(self.hippo, 'nscales', 1)
+        self.output_order = self.nscales * order # features per channel
+        self.max_length = max_length
+
+    def forward(self, inputs):
+        """
+        inputs : (length, batch, channels)
+        output : (length, batch, channels, order), or (length, batch, channels, K * order) for a bank of K windows
+        """
+        L, B, C = inputs.shape
+        if self.measure == 'legs':
+            assert L <= self.max_length, f"VariableMemoryProjection: sequence length {L} exceeds max_length {self.max_length}"
+        # Channels are independent, so they are folded into the batch of a single unroll
+        c = self.hippo(inputs.reshape(L, B*C)) # (length, batch*channels, [K,] order)
+        return c.view(L, B, C, self.output_order)
 
 
 class FunctionApprox(data.TensorDataset):
 
     def __init__(self, length, dt, nbatches, freq=10.0, seed=0):
+        import nengo
         rng = np.random.RandomState(seed=seed)
         process = nengo.processes.WhiteSignal(length * dt, high=freq, y0=0)
         X = np.empty((nbatches, length, 1))
@@ -169,7 +362,43 @@ def test():
     # print(y-z)
 
 
+def memory_precision(T=2000, N=64, nbatches=4, freq=5.0):
+    """ Accuracy of the function approximation when the coefficients are stored in low precision between steps
+
+    Mirrors the storage options of MemoryCell(memory_dtype=...): the recurrence is computed in float32,
+    but the coefficients are rounded to the storage type after every step.
+    int8 uses per-order scales calibrated on the float32 coefficients.
+    """
+    from model.memory import memory_dtypes, quantize_memory, dequantize_memory
+
+    f = FunctionApprox(T, 1./T, nbatches, freq=freq, seed=0).tensors[0] # (nbatches, T, 1)
+    f = f.squeeze(-1).transpose(0, 1) # (T, nbatches)
+
+    legt = HiPPO_LegT(N, 1./T)
+    legs = HiPPO_LegS(N, T)
+    steps = {
+        'legt': lambda c, k: F.linear(c, legt.A) + legt.B * f[k].unsqueeze(-1),
+        'legs': lambda c, k: F.linear(c, legs.A_stacked[k]) + legs.B_stacked[k] * f[k].unsqueeze(-1),
+    }
+    for name, hippo in [('legt', legt), ('legs', legs)]:
+        cs = hippo(f) # (T, nbatches, N)
+        scale = cs.abs().amax(dim=(0, 1)) / 127
+        f_ref = hippo.reconstruct(cs[-1])[..., :T]
+        print(f"{name}: float32 mse {F.mse_loss(f_ref, f.t()).item():.3e}")
+        for dtype_name, dtype in memory_dtypes.items():
+            if dtype == torch.float32:
+                continue
+            c = quantize_memory(torch.zeros(nbatches, N), dtype, scale)
+            for k in range(T):
+                c = quantize_memory(steps[name](dequantize_memory(c, scale), k), dtype, scale)
+            f_approx = hippo.reconstruct(dequantize_memory(c, scale))[..., :T]
+            print(f"  {dtype_name:>8}: mse {F.mse_loss(f_approx, f.t()).item():.3e}, "
+                  f"difference to float32 {F.mse_loss(f_approx, f_ref).item():.3e}, "
+                  f"bytes per coefficient {c.element_size()}")
+
+
 def plot():
+    import matplotlib.pyplot as plt
     T = 10000
     dt = 1e-3
     N = 256
@@ -183,9 +412,9 @@ def plot():
     f = f.squeeze(0).squeeze(-1)
 
     legt = HiPPO_LegT(N, 1./T)
-    f_legt = legt.reconstruct(legt(f))[-1]
+    f_legt = legt.reconstruct(legt(f), last=True)
     legs = HiPPO_LegS(N, T)
-    f_legs = legs.reconstruct(legs(f))[-1]
+    f_legs = legs.reconstruct(legs(f), last=True)
     print(F.mse_loss(f, f_legt))
     print(F.mse_loss(f, f_legs))
 
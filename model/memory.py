@@ -10,6 +10,7 @@ from functools import partial
 from model.rnncell import RNNCell
 from model.orthogonalcell import OrthogonalLinear
 from model.components import Gate, Linear_, Modrelu, get_activation, get_initializer
+from model.profiling import profile_range
 from model.op import LegSAdaptiveTransitionManual, LegTAdaptiveTransitionManual, LagTAdaptiveTransitionManual, TLagTAdaptiveTransitionManual
 
 
@@ -19,6 +20,74 @@ backward_aliases  = ['backward', 'backward_diff', 'backward_euler']
 bilinear_aliases = ['bilinear', 'tustin', 'trapezoidal', 'trapezoid']
 zoh_aliases       = ['zoh']
 
+memory_dtypes = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'int8': torch.int8,
+}
+
+
+def quantize_memory(m, dtype, scale=None, stochastic=True):
+    """ Casts the memory m (..., N) to its storage type. int8 uses per-order scales (N,)
+
+    Each step only changes the memory by O(dt), which is often below the resolution of bfloat16/int8;
+    these types are therefore rounded stochastically, so that small updates are preserved in expectation.
+    stochastic=False rounds to nearest instead, e.g. for deterministic inference.
+    """
+    if dtype == torch.int8:
+        x = m / scale.clamp(min=1e-12)
+        x = torch.floor(x + torch.rand_like(x)) if stochastic else torch.round(x)
+        return torch.clamp(x, -127, 127).to(torch.int8)
+    if dtype == torch.bfloat16 and stochastic:
+        # bfloat16 is the upper half of float32: add random low bits and truncate
+        bits = m.float().view(torch.int32)
+        bits = (bits + torch.randint_like(bits, 0, 1 << 16)) & -(1 << 16)
+        return bits.view(torch.float32).to(torch.bfloat16)
+    return m.to(dtype)
+
+def dequantize_memory(m, scale=None):
+    """ Inverse of quantize_memory, returns a float32 memory """
+    if m.dtype == torch.int8:
+        return m.float() * scale
+    return m.float()
+
+def advance_memory(m, k, power, bits=None):
+    """ Applies a fixed linear step k times by repeated squaring: m (I+A)^T ... (I+A)^T in O(N^2 log k)
+
+    m: (B, M, N), or (B, M, K, 1, N) for K stacked transitions
+    k: int shared by the batch, or (B,) integer tensor of per-sample step counts
+    power: j -> (N, N) or (K, N, N) matrix of 2^j steps acting on row vectors, i.e. ((I+A)^(2^j))^T
+    bits: with a tensor k, an upper bound on the bit length of k. By default it is read from k.max(), which synchronizes with the host
+    """
+    if not isinstance(k, torch.Tensor):
+        j = 0
+        while k >> j:
+            if (k >> j) & 1:
+                m = m @ power(j)
+            j += 1
+        return m
+    k = k.long()
+    if bits is None:
+        bits = (int(k.max()) if k.numel() > 0 else 0).bit_length()
+    for j in range(bits):
+        bit = ((k >> j) & 1).bool().view(-1, *[1] * (m.dim() - 1))
+        m = torch.where(bit, m @ power(j), m)
+    return m
+
+class PowerCache:
+    """ Lazily computed powers P^(2^j) of a fixed matrix, by repeated squaring """
+    def __init__(self, base_fn):
+        self.base_fn = base_fn # () -> P
+        self.powers = []
+
+    def __call__(self, j):
+        if not self.powers:
+            self.powers.append(self.base_fn())
+        while len(self.powers) <= j:
+            self.powers.append(self.powers[-1] @ self.powers[-1])
+        return self.powers[j]
+
 
 class MemoryCell(RNNCell):
     """This class handles the general architectural wiring of the HiPPO-RNN, in particular the interaction between the hidden state and the linear memory state.
@@ -57,6 +126,7 @@ class MemoryCell(RNNCell):
                  memory_activation='id',
                  gate='G', # 'N' | 'G' | UR' # <- 이건 머임 
                  memory_output=False,
+                 memory_dtype=None, # storage type of the memory state: None (float32) | 'float16' | 'bfloat16' | 'int8'
                  **kwargs
                  ):
         self.memory_size       = memory_size # default is 1
@@ -65,9 +135,14 @@ class MemoryCell(RNNCell):
         self.memory_activation = memory_activation
         self.gate              = gate
         self.memory_output     = memory_output
+        self.memory_dtype      = None if memory_dtype is None else memory_dtypes[memory_dtype]
 
         super(MemoryCell, self).__init__(input_size, hidden_size, **kwargs) # 정확한 의미??
 
+        if self.memory_dtype == torch.int8:
+            # Per-order scales, tracked as a running max of |m| / 127 in training mode and frozen in eval mode
+            self.register_buffer('memory_scale', torch.zeros(self.memory_order))
+
 
         self.input_to_hidden_size = self.input_size if self.architecture['hx'] else 0
         self.input_to_memory_size = self.input_size if self.architecture['ux'] else 0
@@ -125,30 +200,34 @@ class MemoryCell(RNNCell):
 
     def forward(self, input, state):
         h, m, time_step = state # hidden state, c(t), t
+        m = self.load_memory(m) # updates are always accumulated in float32
 
         input_to_hidden = input if self.architecture['hx'] else input.new_empty((0,)) # default 'hx' is true
         input_to_memory = input if self.architecture['ux'] else input.new_empty((0,)) # default 'ux' is true
 
         # Construct the update features
-        memory_preact = self.W_uxh(torch.cat((input_to_memory, h), dim=-1))  # (batch, memory_size) # 
-        if self.architecture['um']: # default 'um' is False
-            memory_preact = memory_preact + (m * self.W_um).sum(dim=-1)
-        u = self.memory_activation_fn(memory_preact) # (batch, memory_size) # memory activation fn default: identity
+        with profile_range('memory_projection'):
+            memory_preact = self.W_uxh(torch.cat((input_to_memory, h), dim=-1))  # (batch, memory_size) # 
+            if self.architecture['um']: # default 'um' is False
+                memory_preact = memory_preact + (m * self.W_um).sum(dim=-1)
+            u = self.memory_activation_fn(memory_preact) # (batch, memory_size) # memory activation fn default: identity
 
         # Update the memory
-        m = self.update_memory(m, u, time_step) # (batch, memory_size, memory_order) # c_{t-1} -> c_t
+        with profile_range('update_memory'):
+            m = self.update_memory(m, u, time_step) # (batch, memory_size, memory_order) # c_{t-1} -> c_t
 
         # Update hidden state from memory
-        if self.architecture['hm']: # default 'hm' is True
-            memory_to_hidden = m.view(input.shape[0], self.memory_size*self.memory_order)
-        else:
-            memory_to_hidden = input.new_empty((0,))
-        m_inputs = (torch.cat((input_to_hidden, memory_to_hidden), dim=-1),)
-        hidden_preact = self.W_hxm(*m_inputs)
-
-        if self.architecture['hh']: # default 'hh' is False
-            hidden_preact = hidden_preact + self.W_hh(h)
-        hidden = self.hidden_activation_fn(hidden_preact)
+        with profile_range('hidden_projection'):
+            if self.architecture['hm']: # default 'hm' is True
+                memory_to_hidden = m.view(input.shape[0], self.memory_size*self.memory_order)
+            else:
+                memory_to_hidden = input.new_empty((0,))
+            m_inputs = (torch.cat((input_to_hidden, memory_to_hidden), dim=-1),)
+            hidden_preact = self.W_hxm(*m_inputs)
+
+            if self.architecture['hh']: # default 'hh' is False
+                hidden_preact = hidden_preact + self.W_hh(h)
+            hidden = self.hidden_activation_fn(hidden_preact)
         # print(f"hh is {self.architecture['hh']}") #False
         # print(f"hm is {self.architecture['hm']}") #True
         # print("Hallelujah")
@@ -157,12 +236,13 @@ class MemoryCell(RNNCell):
         if self.gate is None:
             h = hidden
         else:
-            if self.architecture['hh']:
-                m_inputs = torch.cat((m_inputs[0], h), -1),
-            g = self.W_gxm(*m_inputs)
-            h = (1.-g) * h + g * hidden
+            with profile_range('gate'):
+                if self.architecture['hh']:
+                    m_inputs = torch.cat((m_inputs[0], h), -1),
+                g = self.W_gxm(*m_inputs)
+                h = (1.-g) * h + g * hidden
 
-        next_state = (h, m, time_step + 1)
+        next_state = (h, self.store_memory(m), time_step + 1)
         output = self.output(next_state)
 
         return output, next_state
@@ -176,10 +256,35 @@ class MemoryCell(RNNCell):
         """
         raise NotImplementedError
 
+    def store_memory(self, m):
+        """ Converts the float32 memory into its storage type (memory_dtype) """
+        if self.memory_dtype is None:
+            return m
+        if self.memory_dtype == torch.int8:
+            if self.training:
+                # Observe the range of each order, and fake-quantize with a straight-through gradient
+                with torch.no_grad():
+                    scale = m.detach().abs().reshape(-1, self.memory_order).amax(dim=0) / 127
+                    torch.max(self.memory_scale, scale, out=self.memory_scale)
+                m_q = dequantize_memory(quantize_memory(m, torch.int8, self.memory_scale), self.memory_scale)
+                return m + (m_q - m).detach()
+            # The scales are only observed in training mode; uncalibrated (zero) scales would silently zero the memory
+            if not self.memory_scale.any() and m.any():
+                raise RuntimeError("int8 memory: the scales are not calibrated, run the cell in training mode first")
+            return quantize_memory(m, torch.int8, self.memory_scale, stochastic=False)
+        # Rounding is stochastic in training only, so that inference is deterministic
+        return quantize_memory(m, self.memory_dtype, stochastic=self.training)
+
+    def load_memory(self, m):
+        """ Converts a stored memory back to float32 """
+        if m.dtype == torch.float32:
+            return m
+        return dequantize_memory(m, getattr(self, 'memory_scale', None))
+
     def default_state(self, input, batch_size=None):
         batch_size = input.size(0) if batch_size is None else batch_size
         return (input.new_zeros(batch_size, self.hidden_size, requires_grad=False),
-                input.new_zeros(batch_size, self.memory_size, self.memory_order, requires_grad=False),
+                self.store_memory(input.new_zeros(batch_size, self.memory_size, self.memory_order, requires_grad=False)),
                 0)
 
     def output(self, state):
@@ -187,6 +292,7 @@ class MemoryCell(RNNCell):
         h, m, time_step = state
 
         if self.memory_output:
+            m = self.load_memory(m)
             hm = torch.cat((h, m.view(m.shape[0], self.memory_size*self.memory_order)), dim=-1)
             return hm
         else:
@@ -203,7 +309,12 @@ class MemoryCell(RNNCell):
 
 
 class LTICell(MemoryCell):
-    """ A cell implementing Linear Time Invariant dynamics: c' = Ac + Bf. """
+    """ A cell implementing Linear Time Invariant dynamics: c' = Ac + Bf.
+
+    A sequence of K step sizes dt makes a memory bank: every memory channel is remembered at K timescales,
+    each a memory of order N, for a memory of order K * N. The K discretized transitions are stacked into
+    A (K, N, N) and B (K, N, 1), and all timescales are updated by a single batched product.
+    """
 
     def __init__(self, input_size, hidden_size, memory_size, memory_order,
                  A, B,
@@ -212,14 +323,24 @@ class LTICell(MemoryCell):
                  discretization='zoh',
                  **kwargs
                  ):
-        super().__init__(input_size, hidden_size, memory_size, memory_order, **kwargs)
-
+        self.bank = np.ndim(dt) > 0
+        dts = [float(d) for d in dt] if self.bank else [dt]
+        self.nscales = len(dts)
+        super().__init__(input_size, hidden_size, memory_size, memory_order * self.nscales, **kwargs)
 
+        self.dt = dts if self.bank else dt
+        self.discretization = discretization
         C = np.ones((1, memory_order))
         D = np.zeros((1,))
-        dA, dB, _, _, _ = signal.cont2discrete((A, B, C, D), dt=dt, method=discretization)
+        dAs, dBs = [], []
+        for dt_ in dts:
+            dA, dB, _, _, _ = signal.cont2discrete((A, B, C, D), dt=dt_, method=discretization)
+            dAs.append(dA - np.eye(memory_order))  # puts into form: x += Ax
+            dBs.append(dB)
+        dA, dB = np.stack(dAs), np.stack(dBs)
+        if not self.bank:
+            dA, dB = dA[0], dB[0]
 
-        dA = dA - np.eye(memory_order)  # puts into form: x += Ax
         self.trainable_scale = np.sqrt(trainable_scale)
         if self.trainable_scale <= 0.:
             self.register_buffer('A', torch.Tensor(dA))
@@ -232,11 +353,57 @@ class LTICell(MemoryCell):
     # also very useful for orthogonal params
     def update_memory(self, m, u, time_step):
         u = u.unsqueeze(-1) # (B, M, 1)
+        if self.bank:
+            scale = self.trainable_scale if self.trainable_scale > 0. else 1.
+            # One batched product (K, B*M, N) x (K, N, N) for all the timescales
+            m_ = m.reshape(-1, self.nscales, self.A.shape[-1]).transpose(0, 1)
+            m_ = torch.baddbmm(m_ + u.reshape(1, -1, 1) * (self.B * scale).transpose(-1, -2), m_, (self.A * scale).transpose(-1, -2))
+            return m_.transpose(0, 1).reshape(m.shape)
         if self.trainable_scale <= 0.:
             return m + F.linear(m, self.A) + F.linear(u, self.B)
         else:
             return m + F.linear(m, self.A * self.trainable_scale) + F.linear(u, self.B * self.trainable_scale)
 
+    def step_matrix(self):
+        """ The transition I+A of one step, (N, N) or (K, N, N) for a bank """
+        scale = self.trainable_scale if self.trainable_scale > 0. else 1.
+        N = self.A.shape[-1]
+        return torch.eye(N, device=self.A.device) + self.A * scale
+
+    def advance(self, m, k):
+        """ Memory after k steps without input, m (I+A)^k, in O(N^2 log k) instead of k updates
+
+        m: (B, M, N)
+        k: int or (B,) integer tensor
+        The powers (I+A)^(2^j) are cached, unless A is trainable.
+        """
+        if self.trainable_scale > 0.:
+            power = PowerCache(lambda: self.step_matrix().transpose(-1, -2))
+        else:
+            key = (self.A.device, self.A.data_ptr(), self.A._version)
+            if getattr(self, 'powers_key', None) != key:
+                self.powers = PowerCache(lambda: self.step_matrix().transpose(-1, -2))
+                self.powers_key = key
+            power = self.powers
+        if self.bank:
+            return advance_memory(m.view(*m.shape[:-1], self.nscales, 1, -1), k, power).view(m.shape)
+        return advance_memory(m, k, power)
+
+    def kernel(self, L):
+        """ Convolution kernel K (L, memory_order) of update_memory, K[j] = (I+A)^j B
+
+        The memory after k steps from zero is sum_{j<=k} K[k-j] u[j].
+        For a bank, the kernels of the K timescales are concatenated like the memory.
+        """
+        scale = self.trainable_scale if self.trainable_scale > 0. else 1.
+        A = self.step_matrix()
+        K = (self.B * scale).transpose(-1, -2) # (..., 1, N)
+        P = A # A^len(K)
+        while K.shape[-2] < L:
+            K = torch.cat([K, K @ P.transpose(-1, -2)], dim=-2)
+            P = P @ P
+        return K[..., :L, :].movedim(-2, 0).reshape(L, self.memory_order)
+
 class LSICell(MemoryCell):
     """ A cell implementing Linear 'Scale' Invariant dynamics: c' = 1/t (Ac + Bf). """
 
@@ -259,6 +426,7 @@ class LSICell(MemoryCell):
         assert isinstance(init_t, int)
         self.init_t = init_t
         self.max_length = max_length
+        self.discretization = discretization
 
         A_stacked = np.empty((max_length, memory_order, memory_order), dtype=A.dtype)
         B_stacked = np.empty((max_length, memory_order), dtype=B.dtype)
@@ -288,59 +456,121 @@ class LSICell(MemoryCell):
 
 
     def update_memory(self, m, u, time_step):
+        """
+        time_step: int shared by the whole batch, or (B,) LongTensor of per-sample time steps
+        """
         u = u.unsqueeze(-1) # (B, M, 1)
-        t = time_step - 1 + self.init_t
+        if isinstance(time_step, torch.Tensor):
+            return self.update_memory_batched(m, u, time_step)
+        return self.update_memory_step(m, u, time_step - 1 + self.init_t)
+
+    def update_memory_step(self, m, u, t):
+        """ Update of streams at the same position, t the index of the transition (before clamping to max_length) """
         if t < 0:
             return F.pad(u, (0, self.memory_order - 1)) # 뭐지 이게?
         else:
             if t >= self.max_length: t = self.max_length - 1
-            return m + F.linear(m, self.A[t]) + F.linear(u, self.B[t]) # m + m (A_k)^t + u B_k # m is c. u is f. 
-          
+            return m + F.linear(m, self.A[t]) + F.linear(u, self.B[t]) # m + m (A_k)^t + u B_k # m is c. u is f.
+
+    def update_memory_batched(self, m, u, time_step):
+        """ Same update as update_memory, for a batch of streams at different positions
+
+        m: (B, M, N)
+        u: (B, M, 1)
+        time_step: (B,), or a single position as a 0-dim tensor (e.g. the time step of a layer under vmap, see StackedRNN)
+        """
+        t = (time_step.long() - 1 + self.init_t).clamp(-1, self.max_length - 1)
+        if t.dim() == 0:
+            m = m + m @ self.A[t.clamp(min=0)].transpose(-1, -2) + u @ self.B[t.clamp(min=0)].transpose(-1, -2)
+            return torch.where(t < 0, F.pad(u, (0, self.memory_order - 1)), m)
+        # Gathering A[t] per row would build a (B, N, N) tensor: instead each distinct transition is applied once, to its rows
+        steps = t.unique().tolist()
+        if len(steps) == 1:
+            return self.update_memory_step(m, u, steps[0])
+        out = m.new_empty(m.shape)
+        for step in steps:
+            rows = (t == step).nonzero().squeeze(-1)
+            out[rows] = self.update_memory_step(m[rows], u[rows], step)
+        return out
 
 
 class TimeMemoryCell(MemoryCell):
-    """ MemoryCell with timestamped data """
-    def __init__(self, input_size, hidden_size, memory_size, memory_order, **kwargs):
+    """ MemoryCell with timestamped data
+
+    sparse: event-driven mode, where a NaN timestamp marks a row without a new observation.
+      Only the observed rows are gathered into a dense sub-batch and stepped; the others keep their state at no cost.
+      Since the state holds the time of the last observation, the next step of a row jumps directly from it to the new timestamp.
+    """
+    def __init__(self, input_size, hidden_size, memory_size, memory_order, sparse=False, **kwargs):
+        self.sparse = sparse
         super().__init__(input_size-1, hidden_size, memory_size, memory_order, **kwargs)
+
     def forward(self, input, state):
+        if self.sparse:
+            return self.forward_sparse(input, state)
+        return self.step(input, state)
+
+    def forward_sparse(self, input, state):
+        h, m, time_step = state
+        if not isinstance(time_step, torch.Tensor):
+            time_step = input.new_full((input.shape[0],), time_step)
+        observed = ~torch.isnan(input[:, 0])
+        idx = observed.nonzero().squeeze(-1)
+        if idx.numel() < input.shape[0]:
+            _, (h_, m_, time_step_) = self.step(input.index_select(0, idx),
+                                               (h.index_select(0, idx), m.index_select(0, idx), time_step.index_select(0, idx)))
+            h = h.index_copy(0, idx, h_)
+            m = m.index_copy(0, idx, m_)
+            time_step = time_step.index_copy(0, idx, time_step_.to(time_step.dtype))
+        else:
+            _, (h, m, time_step) = self.step(input, (h, m, time_step))
+        next_state = (h, m, time_step)
+        return self.output(next_state), next_state
+
+    def step(self, input, state):
         h, m, time_step = state
+        m = self.load_memory(m)
         timestamp, input = input[:, 0], input[:, 1:]
 
         input_to_hidden = input if self.architecture['hx'] else input.new_empty((0,))
         input_to_memory = input if self.architecture['ux'] else input.new_empty((0,))
 
         # Construct the update features
-        memory_preact = self.W_uxh(torch.cat((input_to_memory, h), dim=-1))  # (batch, memory_size)
-        if self.architecture['um']:
-            memory_preact = memory_preact + (m * self.W_um).sum(dim=-1)
-        u = self.memory_activation_fn(memory_preact) # (batch, memory_size)
+        with profile_range('memory_projection'):
+            memory_preact = self.W_uxh(torch.cat((input_to_memory, h), dim=-1))  # (batch, memory_size)
+            if self.architecture['um']:
+                memory_preact = memory_preact + (m * self.W_um).sum(dim=-1)
+            u = self.memory_activation_fn(memory_preact) # (batch, memory_size)
 
         # Update the memory
-        m = self.update_memory(m, u, time_step, timestamp) # (batch, memory_size, memory_order)
+        with profile_range('update_memory'):
+            m = self.update_memory(m, u, time_step, timestamp) # (batch, memory_size, memory_order)
 
         # Update hidden state from memory
-        if self.architecture['hm']:
-            memory_to_hidden = m.view(input.shape[0], self.memory_size*self.memory_order)
-        else:
-            memory_to_hidden = input.new_empty((0,))
-        m_inputs = (torch.cat((input_to_hidden, memory_to_hidden), dim=-1),)
-        hidden_preact = self.W_hxm(*m_inputs)
+        with profile_range('hidden_projection'):
+            if self.architecture['hm']:
+                memory_to_hidden = m.view(input.shape[0], self.memory_size*self.memory_order)
+            else:
+                memory_to_hidden = input.new_empty((0,))
+            m_inputs = (torch.cat((input_to_hidden, memory_to_hidden), dim=-1),)
+            hidden_preact = self.W_hxm(*m_inputs)
 
-        if self.architecture['hh']:
-            hidden_preact = hidden_preact + self.W_hh(h)
-        hidden = self.hidden_activation_fn(hidden_preact)
+            if self.architecture['hh']:
+                hidden_preact = hidden_preact + self.W_hh(h)
+            hidden = self.hidden_activation_fn(hidden_preact)
 
 
         # Construct gate if necessary
         if self.gate is None:
             h = hidden
         else:
-            if self.architecture['hh']:
-                m_inputs = torch.cat((m_inputs[0], h), -1),
-            g = self.W_gxm(*m_inputs)
-            h = (1.-g) * h + g * hidden
+            with profile_range('gate'):
+                if self.architecture['hh']:
+                    m_inputs = torch.cat((m_inputs[0], h), -1),
+                g = self.W_gxm(*m_inputs)
+                h = (1.-g) * h + g * hidden
 
-        next_state = (h, m, timestamp)
+        next_state = (h, self.store_memory(m), timestamp)
         output = self.output(next_state)
 
         return output, next_state
@@ -397,14 +627,14 @@ class TimeLSICell(TimeMemoryCell):
         u: (B, M)
         t0: (B,) previous time
         t1: (B,) current time
-        """
 
-        if torch.eq(t1, 0.).any():
-            return F.pad(u.unsqueeze(-1), (0, self.memory_order - 1))
-        else:
-            dt = ((t1-t0)/t1).unsqueeze(-1)
-            m = self.transition_fn(dt, m, u)
-        return m
+        Rows at t1 = 0 are initialized from u, the others take a step of size (t1-t0)/t1.
+        The update is branch-free (no host synchronization), so that batches can mix both cases.
+        """
+        init = t1 == 0.
+        dt = ((t1-t0) / torch.where(init, torch.ones_like(t1), t1)).unsqueeze(-1) # finite everywhere, also for rows that are initialized
+        m = self.transition_fn(dt, m, u)
+        return torch.where(init.view(-1, 1, 1), F.pad(u.unsqueeze(-1), (0, self.memory_order - 1)), m)
 
 class TimeLTICell(TimeLSICell):
     """ A cell implementing Linear Time Invariant dynamics: c' = Ac + Bf with timestamped inputs. """
@@ -413,23 +643,58 @@ class TimeLTICell(TimeLSICell):
 
     def __init__(self, input_size, hidden_size, memory_size=1, memory_order=-1,
                  dt=1.0,
+                 max_step=None, # if set, gaps longer than this (in timestamp units) are split into idle steps of this size
+                 max_gap=None, # longest gap expected with max_step, e.g. the time range of the data; bounds the idle steps so that they need no host synchronization
                  **kwargs
                  ):
         if memory_order < 0:
             memory_order = hidden_size
 
         self.dt = dt
+        self.max_step = max_step
+        self.max_gap = max_gap
 
         super().__init__(input_size, hidden_size, memory_size, memory_order, **kwargs)
 
+    def idle_step(self, device):
+        """ Transposed transition matrix of one step of size max_step without input """
+        N = self.memory_order
+        eye = torch.eye(N, device=device).unsqueeze(1) # (N, 1, N): each basis vector as a memory
+        dt = torch.full((N, 1), self.dt * self.max_step, device=device)
+        with torch.no_grad(): # the transition is fixed, so the cached powers do not need a graph
+            return self.transition_fn(dt, eye, eye.new_zeros(N, 1)).squeeze(1)
+
+    def idle_powers(self, device):
+        """ Cached powers of idle_step, recomputed when the step size or the transition matrices change """
+        A = self.transition.A
+        key = (device, self.dt, self.max_step, A.device, A.data_ptr(), A._version)
+        if getattr(self, 'powers_key', None) != key:
+            self.powers = PowerCache(partial(self.idle_step, device))
+            self.powers_key = key
+        return self.powers
+
     def update_memory(self, m, u, t0, t1):
         """
         m: (B, M, N) [batch, memory_size, memory_order]
         u: (B, M)
         t0: (B,) previous time
         t1: (B,) current time
-        """
 
-        dt = self.dt*(t1-t0).unsqueeze(-1)
+        With max_step, a gap is advanced by k = ceil(gap / max_step) - 1 steps of size max_step without input,
+        in closed form through cached powers of the idle transition, followed by a last step of at most max_step with the input.
+        With max_gap, k is capped at the idle steps of a gap of max_gap, and the update needs no host synchronization;
+        longer gaps then end with a last step longer than max_step.
+        """
+        gap = t1 - t0
+        if self.max_step is not None:
+            k = (torch.ceil(gap / self.max_step) - 1).clamp(min=0)
+            bits = None
+            if self.max_gap is not None:
+                kmax = max(math.ceil(self.max_gap / self.max_step) - 1, 0)
+                k = k.clamp(max=kmax)
+                bits = kmax.bit_length()
+            m = advance_memory(m, k.long(), self.idle_powers(m.device), bits=bits)
+            gap = gap - k * self.max_step
+        dt = self.dt*gap.unsqueeze(-1)
         m = self.transition_fn(dt, m, u)
         return m
@@ -1,11 +1,16 @@
 import torch
 import torch.nn as nn
+from collections.abc import Mapping
 from functools import partial
 
-from model.rnn import RNN, RNNWrapper, LSTMWrapper
+from model.rnn import RNN, StackedRNN, BidirectionalRNN, RNNWrapper, LSTMWrapper
 from model import rnncell, opcell # TODO: this is just to force cell_registry to update. There is probably a better programming pattern for this
 from model.rnncell import CellBase
+from model.memory import TimeMemoryCell
+from model.hippo import VariableMemoryProjection
+from model.qrnn import QRNN
 from model.orthogonalcell import OrthogonalCell
+from model.profiling import profile_range
 
 class Model(nn.Module):
 
@@ -22,6 +27,11 @@ class Model(nn.Module):
         ff=False,
         dropout=0.0,
         split=0,
+        num_layers=1,
+        wavefront=False,
+        bidirectional=False,
+        share_directions=False,
+        vectorize_directions=False,
     ):
         super(Model, self).__init__()
 
@@ -33,8 +43,12 @@ class Model(nn.Module):
         self.dropout = dropout
         self.split = split
 
+        # Token id inputs (batch, length): embed_args {'embed_dim': d} learns an embedding, i.e. looks up
+        # the columns of the input weights, while {'one_hot': True} expands them on the device into the
+        # one-hot vectors the model would otherwise have been fed
         cell_args['input_size'] = input_size
-        if embed_args is not None:
+        self.one_hot = embed_args is not None and embed_args.get('one_hot', False)
+        if embed_args is not None and not self.one_hot:
             self.embed_dim = embed_args['embed_dim']
             self.embedding = nn.Embedding(input_size, self.embed_dim)
             cell_args['input_size'] = self.embed_dim
@@ -43,16 +57,15 @@ class Model(nn.Module):
         ### Handle optional Hippo preprocessing <- 이게 뭐지??
         self.preprocess = preprocess 
         if self.preprocess is not None:
-            assert isinstance(self.preprocess, dict)
+            assert isinstance(self.preprocess, Mapping)
             assert 'order' in self.preprocess
             assert 'measure' in self.preprocess
             self.hippo = VariableMemoryProjection(**self.preprocess)
-            cell_args['input_size'] *= (self.preprocess['order']+1) # will append this output to original channels
+            cell_args['input_size'] *= (self.hippo.output_order+1) # will append this output to original channels
 
         ### Construct main RNN
         if ff: # feedforward model
-            cell_args['input_size'] = input_size
-            self.rnn = QRNN(**cell_args)
+            self.rnn = QRNN(**cell_args, dropout=self.dropout)
         else:
             # Initialize proper cell type
             if cell == 'lstm':
@@ -65,9 +78,27 @@ class Model(nn.Module):
                 else:
                     assert False, f"cell {cell} not supported"
 
-                self.rnn = RNN(cell_ctor(**cell_args), dropout=self.dropout)
+                def make_rnn():
+                    if bidirectional:
+                        assert num_layers == 1, "bidirectional models only support num_layers=1"
+                        return BidirectionalRNN(
+                            cell_ctor(**cell_args),
+                            None if share_directions else cell_ctor(**cell_args),
+                            dropout=self.dropout,
+                            reverse_timestamps=isinstance(cell_ctor, type) and issubclass(cell_ctor, TimeMemoryCell),
+                            vectorize=vectorize_directions,
+                        )
+                    if num_layers == 1:
+                        return RNN(cell_ctor(**cell_args), dropout=self.dropout)
+                    # Layers after the first consume the outputs of the previous layer
+                    cells = [cell_ctor(**cell_args)]
+                    layer_args = {**cell_args, 'input_size': cells[0].output_size()}
+                    cells += [cell_ctor(**layer_args) for _ in range(num_layers-1)]
+                    return StackedRNN(cells, dropout=self.dropout, wavefront=wavefront)
+
+                self.rnn = make_rnn()
                 if self.split > 0:
-                    self.initial_rnn = RNN(cell_ctor(**cell_args), dropout=self.dropout)
+                    self.initial_rnn = make_rnn()
 
 
         ### Construct output head
@@ -77,18 +108,21 @@ class Model(nn.Module):
 
     # @profile
     def forward(self, inputs, len_batch=None):
-        B, L, C = inputs.shape
+        """ inputs: (batch, length, channels), or (batch, length) integer token ids with embed_args """
+        B, L = inputs.shape[:2]
         inputs = inputs.transpose(0, 1) # .unsqueeze(-1)  # (seq_length, batch, channels)
+        if self.one_hot:
+            inputs = nn.functional.one_hot(inputs.long(), self.input_size).float()
 
         # Apply Hippo preprocessing if necessary
         if self.preprocess is not None:
             p = self.hippo(inputs)
-            p = p.reshape(L, B, self.input_size * self.preprocess['order'])
+            p = p.reshape(L, B, self.input_size * self.hippo.output_order)
             inputs = torch.cat([inputs, p], dim=-1)
 
         # Handle embedding
         if hasattr(self, 'embedding'):
-            inputs = self.embedding(inputs)
+            inputs = self.embedding(inputs.long())
         if len_batch is not None:
             inputs = nn.utils.rnn.pack_padded_sequence(inputs, len_batch, enforce_sorted=False)
 
@@ -105,9 +139,11 @@ class Model(nn.Module):
             # get last output tokens
             outputs = outputs[-self.output_len:,:,:] # output sequence의 마지막 self.output_len 개수 만큼을 선택해서 mlp에 먹임
             outputs = outputs.transpose(0, 1)
-            return self.output_mlp(outputs)
+            with profile_range('output_head'):
+                return self.output_mlp(outputs)
         else:
             _, state = self.rnn(inputs, init_state=initial_state, return_output=False) #return_output = False -> return is state
             state = self.rnn.output(state)
-            return self.output_mlp(state)
+            with profile_range('output_head'):
+                return self.output_mlp(state)
 
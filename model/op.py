@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import math
 import numpy as np
 from scipy import signal
 from scipy import linalg as la
@@ -67,6 +68,42 @@ def transition(measure, N, **measure_args):
 
 
 
+def rank_correction(measure, N):
+    """ Low-rank P (N, r) such that A + P P^T is a normal matrix, for the A of transition(measure, N) """
+    n = np.arange(N, dtype=np.float64)
+    if measure == 'legs':
+        P = np.sqrt(n + .5)[:, None]
+    elif measure == 'legt':
+        r = np.sqrt(2*n + 1)
+        P = np.stack([np.where(n % 2 == 0, r, 0.), np.where(n % 2 == 1, r, 0.)], axis=-1)
+    elif measure == 'lagt':
+        P = np.sqrt(.5) * np.ones((N, 1))
+    else:
+        raise NotImplementedError(f"rank_correction: measure {measure} not supported")
+    return P
+
+def nplr(measure, N, **measure_args):
+    """ Normal plus low-rank factorization A = V diag(Lambda) V^-1 - P Q^T of the A of transition(measure, N)
+
+    Returns Lambda (N,), V (N, N), V^-1 (N, N), P (N, r), Q (N, r) and B (N,)
+    """
+    if measure == 'lmu':
+        # lmu is similar to legt: A_lmu = T A_legt T^-1 and B_lmu = T B_legt with T = diag((-1)^n sqrt(2n+1))
+        Lambda, V, V_inv, P, Q, B = nplr('legt', N)
+        n = np.arange(N, dtype=np.float64)
+        T = (-1.)**n * np.sqrt(2*n + 1)
+        return Lambda, T[:, None] * V, V_inv / T[None, :], T[:, None] * P, Q / T[:, None], T * B
+    A, B = transition(measure, N, **measure_args)
+    P = rank_correction(measure, N)
+    AP = A + P @ P.T
+    # AP = d I + S with S skew-symmetric, which is diagonalized by the Hermitian matrix -iS
+    d = np.mean(np.diagonal(AP))
+    S = AP - d * np.eye(N)
+    assert np.allclose(S, -S.T), f"nplr: A + P P^T is not normal for measure {measure}"
+    w, V = np.linalg.eigh(-1j * S)
+    return d + 1j * w, V, V.conj().T, P, P, B[:, 0]
+
+
 class AdaptiveTransition(nn.Module):
     def precompute_forward(self):
         raise NotImplementedError
@@ -264,3 +301,89 @@ class LagTAdaptiveTransitionManual(ManualAdaptiveTransition):
 
 class TLagTAdaptiveTransitionManual(ManualAdaptiveTransition):
     measure = 'tlagt'
+
+
+class DPLRTransition(AdaptiveTransition):
+    """ Diagonal plus low-rank form of a transition: in the basis diagonalizing its normal part, A = Lambda - P Q^*
+
+    States u are complex vectors in that basis, see to_diagonal and from_diagonal.
+    forward_mult and inverse_mult (through the Woodbury identity) cost O(N r) with r <= 2 instead of O(N^2),
+    so the forward_diff, backward_diff and bilinear rules apply in O(N) per step.
+    """
+    def __init__(self, measure, N, **measure_args):
+        super().__init__()
+        self.N = N
+        Lambda, V, V_inv, P, Q, B = nplr(measure, N, **measure_args)
+        # The factorization is kept in double precision for kernel(), the buffers are single precision.
+        # They are determined by the measure, so they are not saved in the state dict
+        self.nplr = (Lambda, V, V_inv, P, Q, B)
+        self.register_buffer('Lambda', torch.tensor(Lambda, dtype=torch.cfloat), persistent=False) # (N,)
+        self.register_buffer('P', torch.tensor((V_inv @ P).T, dtype=torch.cfloat), persistent=False) # (r, N)
+        self.register_buffer('Q', torch.tensor(Q.T @ V, dtype=torch.cfloat), persistent=False) # (r, N)
+        self.register_buffer('B', torch.tensor(V_inv @ B, dtype=torch.cfloat), persistent=False) # (N,)
+        self.register_buffer('V', torch.tensor(V, dtype=torch.cfloat), persistent=False)
+        self.register_buffer('V_inv', torch.tensor(V_inv, dtype=torch.cfloat), persistent=False)
+
+    def to_diagonal(self, x):
+        """ HiPPO coefficients (..., N) to the diagonal basis """
+        return F.linear(x.to(self.V_inv.dtype), self.V_inv)
+
+    def from_diagonal(self, x):
+        """ Diagonal basis (..., N) to real HiPPO coefficients """
+        return F.linear(x, self.V).real
+
+    def forward_mult(self, u, delta, **kwargs):
+        """ Computes (I + d A) u = u + d (Lambda u - P Q^* u) """
+        if isinstance(delta, torch.Tensor):
+            delta = delta.unsqueeze(-1)
+        return u + delta * (self.Lambda * u - (u @ self.Q.t()) @ self.P)
+
+    def inverse_mult(self, u, delta, **kwargs):
+        """ Computes (I - d A)^-1 u = (D^-1 + d P Q^*)^-1 u with D = (I - d Lambda)^-1, by the Woodbury identity:
+        D u - D P d (I + d Q^* D P)^-1 Q^* D u
+        """
+        if isinstance(delta, torch.Tensor):
+            delta = delta.unsqueeze(-1)
+        D = 1. / (1. - delta * self.Lambda) # (..., N)
+        x = D * u
+        QDP = torch.einsum('rn, ...n, sn -> ...rs', self.Q, D, self.P) # (..., r, r)
+        I = torch.eye(QDP.shape[-1], dtype=QDP.dtype, device=QDP.device)
+        dQDP = delta.unsqueeze(-1) * QDP if isinstance(delta, torch.Tensor) else delta * QDP
+        y = torch.linalg.solve(I + dQDP, (x @ self.Q.t()).unsqueeze(-1))[..., 0] # (..., r)
+        return x - D * ((delta * y) @ self.P)
+
+    def kernel(self, dt, L):
+        """ Convolution kernel K (L, N) of the bilinear discretization, K[j] = dA^j dB, in the HiPPO basis
+
+        Evaluates the generating function sum_{j<L} dA^j dB z^j at the L roots of unity and inverts it with an FFT.
+        For the bilinear rule it equals ((1-z)/dt - (1+z)/2 A)^-1 (I - dA^L) B, whose inverse in the diagonal basis
+        is a Cauchy-like sum 1/(c1 - c2 Lambda) with a Woodbury correction: O(L N) in total, plus one change of basis.
+        """
+        Lambda, V, V_inv, P, Q, B = [torch.tensor(x, dtype=torch.cdouble, device=self.Lambda.device) for x in self.nplr]
+        P, Q = V_inv @ P, Q.t() @ V # (N, r), (r, N)
+        r = P.shape[1]
+        I = torch.eye(r, dtype=P.dtype, device=P.device)
+
+        def solve(c1, c2, x):
+            """ (c1 - c2 A)^-1 x in the diagonal basis, for vectors of coefficients c1, c2 (Z,) and x (N,) """
+            R = 1. / (c1[:, None] - c2[:, None] * Lambda) # (Z, N)
+            y = R * x
+            K = torch.einsum('rn, zn, ns -> zrs', Q, R, P)
+            z = torch.linalg.solve(I + c2[:, None, None] * K, (y @ Q.t()).unsqueeze(-1))[..., 0]
+            return y - R * ((c2[:, None] * z) @ P.t())
+
+        # Truncation to length L: B' = (I - dA^L) B, stepping the O(N) bilinear rule L times
+        one = torch.ones(1, dtype=P.dtype, device=P.device)
+        x = B_ = V_inv @ B
+        for _ in range(L):
+            x = solve(2. / dt * one, one, (2. / dt) * x + (Lambda * x - (x @ Q.t()) @ P.t()))[0]
+        B_ = B_ - x
+
+        z = torch.exp(-2j * math.pi * torch.arange(L, device=P.device) / L)
+        c1, c2 = (1. - z) / dt, (1. + z) / 2.
+        G = solve(c1[1:], c2[1:], B_) # (L-1, N)
+        # At z = 1, c1 = 0 and Lambda may have zero eigenvalues: solve A x = -B' directly
+        G0 = torch.linalg.solve(torch.diag(Lambda) - P @ Q, -B_)
+        G = torch.cat([G0.unsqueeze(0), G], dim=0)
+        K = torch.fft.ifft(G, dim=0) # (L, N)
+        return (K @ V.t()).real.to(torch.float)
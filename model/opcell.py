@@ -4,7 +4,14 @@ from torch.nn import functional as F
 import numpy as np
 
 from model.memory import LTICell, LSICell
-from model.op import transition
+from model.memory import bilinear_aliases
+from model.op import transition, DPLRTransition
+from model import profiling
+
+try:
+    import hippo # C++ extension in csrc/
+except ImportError:
+    hippo = None
 
 
 class OPLTICell(LTICell):
@@ -19,7 +26,18 @@ class OPLTICell(LTICell):
 
         # A, B = transition(type(self).measure, memory_order)
         A, B = transition(type(self).measure, memory_order, **measure_args)
+        self.measure_args = measure_args
         super().__init__(input_size, hidden_size, memory_size, memory_order, A, B, **kwargs)
+
+    def kernel(self, L):
+        """ For the bilinear discretization, the kernel is computed from the DPLR form of A in O(L N) """
+        if self.discretization not in bilinear_aliases or self.trainable_scale > 0. or type(self).measure not in ['legs', 'legt', 'lagt', 'lmu']:
+            return super().kernel(L)
+        if not hasattr(self, 'dplr'):
+            self.dplr = DPLRTransition(type(self).measure, self.A.shape[-1], **self.measure_args).to(self.A.device)
+        if self.bank:
+            return torch.cat([self.dplr.kernel(dt, L) for dt in self.dt], dim=-1)
+        return self.dplr.kernel(self.dt, L)
         
         
 class OPLSICell(LSICell):
@@ -51,6 +69,42 @@ class LegendreTranslateSCell(OPLSICell):
 class LegendreScaleCell(OPLSICell): # legs class
     name = 'legs'
     measure = 'legs'
+    fused_max_batch = 4 # beyond this the GEMMs of the ATen path are faster than the fused matrix-vector products
+
+    def fusable(self, input, state):
+        """ Whether a step can run as the single fused C++ op hippo.legs_cell_step
+
+        This covers small-batch inference on CPU with the default architecture: gated, tanh hidden activation, identity memory activation,
+        bilinear discretization and float32 memory. Everything else, including autograd, profiling and vmap, uses the ATen path.
+        """
+        if hippo is None or torch.is_grad_enabled() or profiling.config.record or profiling.config.timing:
+            return False
+        h, m, time_step = state
+        if input.shape[0] > self.fused_max_batch:
+            return False
+        if input.device.type != 'cpu' or input.dtype != torch.float32 or m.dtype != torch.float32:
+            return False
+        if torch._C._functorch.is_functorch_wrapped_tensor(input) or torch._C._functorch.is_functorch_wrapped_tensor(h):
+            return False
+        a = self.architecture
+        return (a['ux'] and a['hx'] and a['hm'] and a['bias'] and not a['um'] and not a['hh']
+                and self.gate == 'G' and self.memory_activation == 'id' and self.hidden_activation == 'tanh'
+                and self.discretization in bilinear_aliases and self.memory_dtype is None)
+
+    def forward(self, input, state):
+        if not self.fusable(input, state):
+            return super().forward(input, state)
+        h, m, time_step = state
+        if isinstance(time_step, torch.Tensor):
+            h, m = hippo.legs_cell_step(input, h, m, 0, time_step, self.init_t, self.max_length,
+                                        self.W_uxh.weight, self.W_uxh.bias, self.W_hxm.weight, self.W_hxm.bias,
+                                        self.W_gxm.W_g.weight, self.W_gxm.W_g.bias)
+        else:
+            h, m = hippo.legs_cell_step(input, h, m, time_step, None, self.init_t, self.max_length,
+                                        self.W_uxh.weight, self.W_uxh.bias, self.W_hxm.weight, self.W_hxm.bias,
+                                        self.W_gxm.W_g.weight, self.W_gxm.W_g.bias)
+        next_state = (h, m, time_step + 1)
+        return self.output(next_state), next_state
     
 class LegendreScaleTCell(OPLTICell):
     name = 'legst'
@@ -0,0 +1,82 @@
+""" Opt-in instrumentation of the per-timestep components of the models.
+
+Components are wrapped in profile_range(name), which can
+  - emit torch.autograd.profiler.record_function ranges, visible in torch.profiler traces (record=True)
+  - accumulate the wall time spent in each component (timing=True), e.g. aggregated per epoch by pl_runner
+
+Both are disabled by default, in which case profile_range returns a shared no-op context manager.
+"""
+
+import time
+from collections import defaultdict
+
+import torch
+
+
+class _Config:
+    record = False
+    timing = False
+
+config = _Config()
+times = defaultdict(float) # name -> accumulated seconds
+counts = defaultdict(int) # name -> number of calls
+
+
+def enable(record=True, timing=False):
+    config.record = record
+    config.timing = timing
+
+def disable():
+    config.record = False
+    config.timing = False
+
+def reset():
+    times.clear()
+    counts.clear()
+
+def summary():
+    """ Returns {name: (seconds, calls)} of the components timed since the last reset """
+    return {name: (times[name], counts[name]) for name in times}
+
+
+class _NullRange:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_null_range = _NullRange()
+
+
+class _Range:
+    def __init__(self, name):
+        self.name = name
+        self.range = torch.autograd.profiler.record_function(name) if config.record else None
+        self.timing = config.timing
+
+    def __enter__(self):
+        if self.range is not None:
+            self.range.__enter__()
+        if self.timing:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize() # Kernels are asynchronous, so wall time is only meaningful after a sync
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.timing:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            times[self.name] += time.perf_counter() - self.start
+            counts[self.name] += 1
+        if self.range is not None:
+            self.range.__exit__(*args)
+        return False
+
+
+def profile_range(name):
+    """ Context manager delimiting one component of a step """
+    if not (config.record or config.timing):
+        return _null_range
+    return _Range(name)
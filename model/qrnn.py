@@ -0,0 +1,63 @@
+import torch
+import torch.nn as nn
+
+from model import unroll
+from model.hippo import VariableMemoryProjection
+
+
+class QRNN(nn.Module):
+    """ Feed-forward sequence model with HiPPO memory features and QRNN f-pooling (Bradbury et al. 2016)
+
+    Every stage is parallel over the sequence:
+      u = W_u x                          position-wise projection to memory_size channels
+      c = HiPPO(u)                       (length, batch, memory_size, memory_order) coefficients, by a parallel scan
+      z = tanh(W_z [x, c]), f = sigmoid(W_f [x, c])
+      h[t] = f[t] * h[t-1] + (1-f[t]) * z[t]   elementwise recurrence, also a parallel scan
+    Satisfies the interface of RNN (forward, output, output_size) so that it can be used as Model(ff=True).
+    """
+
+    def __init__(self, input_size, hidden_size, memory_size=1, memory_order=-1,
+                 measure='legt', dt=None, max_length=1024, dropout=0.0):
+        super().__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.memory_size = memory_size
+        self.memory_order = memory_order if memory_order > 0 else hidden_size
+
+        self.W_u = nn.Linear(input_size, memory_size)
+        self.memory = VariableMemoryProjection(order=self.memory_order, measure=measure, dt=dt, max_length=max_length)
+        features = input_size + memory_size * self.memory.nscales * self.memory_order
+        self.W_zf = nn.Linear(features, 2 * hidden_size)
+        self.dropout = nn.Dropout(p=dropout) if dropout > 0.0 else nn.Identity()
+
+    def forward(self, inputs, init_state=None, return_output=False):
+        """
+        inputs : [length, batch, dim] or PackedSequence
+        init_state : (batch, hidden_size) initial hidden state, defaults to zeros
+        Returns outputs [length, batch, hidden_size] (padded if inputs are packed) and the final hidden state
+        """
+        lengths = None
+        if isinstance(inputs, nn.utils.rnn.PackedSequence):
+            inputs, lengths = nn.utils.rnn.pad_packed_sequence(inputs)
+        L, B, _ = inputs.shape
+
+        c = self.memory(self.W_u(inputs)) # (L, B, memory_size, memory_order)
+        features = torch.cat((inputs, c.view(L, B, -1)), dim=-1)
+        z, f = self.W_zf(self.dropout(features)).chunk(2, dim=-1)
+        z, f = torch.tanh(z), torch.sigmoid(f)
+        outputs = unroll.variable_unroll_diagonal(f, (1. - f) * z, init_state) # (L, B, hidden_size)
+
+        if lengths is None:
+            state = outputs[-1]
+        else:
+            state = outputs[lengths.to(outputs.device) - 1, torch.arange(B, device=outputs.device)]
+        return outputs if return_output else None, state
+
+    def state_size(self):
+        return self.hidden_size
+
+    def output_size(self):
+        return self.hidden_size
+
+    def output(self, state):
+        return state
@@ -133,6 +133,296 @@ class RNN(nn.Module):
         return self.cell.output(state)
 
 
+class StackedRNN(nn.Module):
+    """ A stack of RNN cells, where layer k+1 consumes the outputs of layer k
+
+    With wavefront=True the layers are scheduled along the diagonals of the (layer, time) grid:
+    on diagonal d, layer k processes step d-k, which only depends on the outputs of the previous diagonal.
+    All layers after the first share a configuration, so their steps of a diagonal are computed in a single
+    call of the cell, vectorized over their stacked parameters (torch.func.vmap).
+    This takes L+K-1 batched steps instead of the K*L steps of running the layers one after another, which saves
+    kernel launches on accelerators; on CPU the vectorized steps are slower than the layers in sequence, the default.
+
+    dropout is applied to the outputs passed between layers (as in nn.LSTM), not within the recurrence.
+    """
+
+    def __init__(self, cells, dropout=0.0, wavefront=False):
+        super().__init__()
+        self.layers = nn.ModuleList([RNN(cell) for cell in cells])
+        self.wavefront = wavefront
+        self.dropout = nn.Dropout(p=dropout) if dropout > 0.0 else None
+
+    @property
+    def cells(self):
+        return [layer.cell for layer in self.layers]
+
+    def _batchable(self):
+        """ Whether the layers after the first can be vectorized together """
+        cells = self.cells[1:]
+        if len(cells) < 2:
+            return False
+        def shapes(cell):
+            return [(name, x.shape) for name, x in list(cell.named_parameters()) + list(cell.named_buffers())]
+        return all(type(cell) is type(cells[0]) and shapes(cell) == shapes(cells[0]) for cell in cells) \
+            and getattr(cells[0], 'memory_dtype', None) != torch.int8 # int8 calibration updates buffers in place
+
+    def _drop(self, x):
+        if self.dropout is None:
+            return x
+        if isinstance(x, nn.utils.rnn.PackedSequence):
+            return x._replace(data=self.dropout(x.data))
+        return self.dropout(x)
+
+    def forward(self, inputs, init_state=None, return_output=False):
+        """
+        inputs : [length, batch, dim]
+        init_state : tuple of per-layer states
+        Returns the outputs of the last layer, and the tuple of per-layer states
+        """
+        if init_state is None:
+            init_state = (None,) * len(self.layers)
+        if not self.wavefront or isinstance(inputs, nn.utils.rnn.PackedSequence):
+            return self._forward_sequential(inputs, init_state, return_output)
+        return self._forward_wavefront(inputs, init_state, return_output)
+
+    def _forward_sequential(self, inputs, init_state, return_output):
+        states = []
+        outputs = inputs
+        for k, (layer, state) in enumerate(zip(self.layers, init_state)):
+            last = k == len(self.layers) - 1
+            outputs, state = layer(outputs, init_state=state, return_output=return_output or not last)
+            if not last:
+                outputs = self._drop(outputs)
+            states.append(state)
+        return outputs, tuple(states)
+
+    def _forward_wavefront(self, inputs, init_state, return_output):
+        L, batch_size = inputs.shape[:2]
+        K = len(self.layers)
+        cells = self.cells
+        states = [cell.default_state(inputs[0], batch_size) if state is None else state
+                  for cell, state in zip(cells, init_state)]
+
+        batched = self._batchable()
+        if batched:
+            # Stack the parameters of layers 1..K-1 once; slices of these stay differentiable w.r.t. every layer
+            names = [name for name, _ in cells[1].named_parameters()]
+            buffer_names = [name for name, _ in cells[1].named_buffers()]
+            params = {name: torch.stack([cell.get_parameter(name) for cell in cells[1:]]) for name in names}
+            buffers = {name: torch.stack([cell.get_buffer(name) for cell in cells[1:]]) for name in buffer_names}
+            # States of layers 1..K-1 are stacked along a leading layer dimension; time steps become tensors
+            if isinstance(states[1], tuple):
+                stacked = tuple(torch.stack([torch.as_tensor(x, device=inputs.device) for x in xs]) for xs in zip(*states[1:]))
+            else:
+                stacked = torch.stack(states[1:])
+            def cell_step(tensors, input, state):
+                return torch.func.functional_call(cells[1], tensors, (input, state))
+            step = torch.func.vmap(cell_step, randomness='different') # e.g. stochastic rounding of the memory
+
+        outputs = []
+        layer_outputs = [None] * K # output of each layer on the previous diagonal
+        for d in range(L + K - 1):
+            lo, hi = max(0, d - L + 1), min(K - 1, d) # active layers on this diagonal
+            new_outputs = list(layer_outputs)
+            if lo == 0:
+                new_outputs[0], states[0] = cells[0](inputs[d], states[0])
+            if hi >= 1:
+                first = max(lo, 1)
+                layer_inputs = [self._drop(layer_outputs[k-1]) for k in range(first, hi+1)]
+                if batched:
+                    i, j = first - 1, hi # slice of the stacked layers
+                    p = {name: x[i:j] for name, x in params.items()}
+                    b = {name: x[i:j] for name, x in buffers.items()}
+                    out, state = step((p, b), torch.stack(layer_inputs), apply_tuple(stacked, lambda x: x[i:j]))
+                    if i == 0 and j == K - 1:
+                        stacked = state
+                    else:
+                        stacked = concat_tuple([apply_tuple(stacked, lambda x: x[:i]), state, apply_tuple(stacked, lambda x: x[j:])])
+                    new_outputs[first:hi+1] = torch.unbind(out)
+                else:
+                    for k, x in zip(range(first, hi+1), layer_inputs):
+                        new_outputs[k], states[k] = cells[k](x, states[k])
+            layer_outputs = new_outputs
+            if return_output and hi == K - 1:
+                outputs.append(layer_outputs[-1])
+
+        if batched:
+            states[1:] = [apply_tuple(stacked, lambda x: x[k]) for k in range(K - 1)]
+        return torch.stack(outputs) if return_output else None, tuple(states)
+
+    def state_size(self):
+        return sum(layer.state_size() for layer in self.layers)
+
+    def output_size(self):
+        return self.layers[-1].output_size()
+
+    def output(self, state):
+        return self.layers[-1].output(state[-1])
+
+
+def reverse_padded(inputs, lengths=None):
+    """ Reverses each sequence of a padded batch in time, within its length (the padding stays at the end)
+
+    inputs : [length, batch, ...]
+    lengths : (batch,) lengths of the sequences, or None if they all have the full length
+    """
+    if lengths is None:
+        return inputs.flip(0)
+    L = inputs.size(0)
+    t = torch.arange(L, device=inputs.device).unsqueeze(1) # (L, 1)
+    lengths = lengths.to(inputs.device).unsqueeze(0) # (1, B)
+    index = torch.where(t < lengths, lengths - 1 - t, t) # (L, B)
+    index = index.view(*index.shape, *[1]*(inputs.dim()-2)).expand_as(inputs)
+    return inputs.gather(0, index)
+
+
+class BidirectionalRNN(nn.Module):
+    """ Runs a cell over the sequences and their time reversals in a single pass
+
+    With a single cell, both directions share its parameters and are stacked along the batch dimension,
+    so that the Python loop over time runs once for both directions.
+    With a second cell for the reverse direction, the two directions run back to back. With vectorize=True
+    (which requires cells of the same configuration), they are instead stacked along a leading dimension and each step
+    is one call of the cell vectorized over their parameters (torch.func.vmap). This saves kernel launches on GPU,
+    but is slower than two passes on CPU.
+
+    The output is the concatenation of the outputs of both directions.
+    reverse_timestamps: the inputs carry timestamps in channel 0 (see TimeMemoryCell), which are mirrored for the
+        reverse direction so that they are increasing
+    """
+
+    def __init__(self, cell, cell_reverse=None, dropout=0.0, reverse_timestamps=False, vectorize=False):
+        super().__init__()
+        self.rnn = RNN(cell, dropout=dropout)
+        self.rnn_reverse = None if cell_reverse is None else RNN(cell_reverse, dropout=dropout)
+        self.reverse_timestamps = reverse_timestamps
+        self.vectorize = vectorize
+
+    @property
+    def cell_reverse(self):
+        return None if self.rnn_reverse is None else self.rnn_reverse.cell
+
+    def forward(self, inputs, init_state=None, return_output=False):
+        """
+        inputs : [length, batch, dim] or PackedSequence
+        init_state : (forward state, reverse state)
+        Returns outputs [length, batch, 2*output_size] (padded if inputs are packed), and (forward state, reverse state)
+        """
+        is_packed = isinstance(inputs, nn.utils.rnn.PackedSequence)
+        if is_packed:
+            inputs, lengths = nn.utils.rnn.pad_packed_sequence(inputs)
+        else:
+            lengths = None
+        batch_size = inputs.size(1)
+        reversed_inputs = reverse_padded(inputs, lengths)
+        if self.reverse_timestamps:
+            last = inputs[-1, :, 0] if lengths is None else inputs[lengths.to(inputs.device) - 1, torch.arange(batch_size), 0]
+            reversed_inputs = torch.cat([last.unsqueeze(-1) - reversed_inputs[..., :1], reversed_inputs[..., 1:]], dim=-1)
+
+        if self.cell_reverse is None:
+            inputs = torch.cat([inputs, reversed_inputs], dim=1)
+            if is_packed:
+                inputs = nn.utils.rnn.pack_padded_sequence(inputs, torch.cat([lengths, lengths]), enforce_sorted=False)
+            if init_state is not None:
+                init_state = concat_tuple(list(init_state))
+            outputs, state = self.rnn(inputs, init_state=init_state, return_output=return_output)
+            if is_packed and return_output:
+                outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs)
+            states = (apply_tuple(state, lambda x: x[:batch_size]), apply_tuple(state, lambda x: x[batch_size:]))
+            if return_output:
+                outputs = (outputs[:, :batch_size], outputs[:, batch_size:])
+        elif self.vectorize:
+            outputs, states = self._forward_vectorized(torch.stack([inputs, reversed_inputs]), lengths, init_state, return_output)
+        else:
+            outputs, states = self._forward_separate(inputs, reversed_inputs, lengths, init_state, return_output)
+
+        if return_output:
+            outputs_forward, outputs_reverse = outputs
+            # Align the reverse outputs with the forward time steps
+            outputs = torch.cat([outputs_forward, reverse_padded(outputs_reverse, lengths)], dim=-1)
+        return outputs if return_output else None, states
+
+    def _forward_separate(self, inputs, reversed_inputs, lengths, init_state, return_output):
+        """ One pass of each direction with its own cell """
+        if init_state is None:
+            init_state = (None, None)
+        outputs, states = [], []
+        for rnn, x, state in zip([self.rnn, self.rnn_reverse], [inputs, reversed_inputs], init_state):
+            if lengths is not None:
+                x = nn.utils.rnn.pack_padded_sequence(x, lengths, enforce_sorted=False)
+            output, state = rnn(x, init_state=state, return_output=return_output)
+            if lengths is not None and return_output:
+                output, _ = nn.utils.rnn.pad_packed_sequence(output, total_length=inputs.size(0))
+            outputs.append(output)
+            states.append(state)
+        return (tuple(outputs) if return_output else None), tuple(states)
+
+    def _forward_vectorized(self, inputs, lengths, init_state, return_output):
+        """ inputs : [2, length, batch, dim] """
+        cells = [self.rnn.cell, self.cell_reverse]
+        params = {name: torch.stack([cell.get_parameter(name) for cell in cells]) for name, _ in cells[0].named_parameters()}
+        buffers = {name: torch.stack([cell.get_buffer(name) for cell in cells]) for name, _ in cells[0].named_buffers()}
+        if init_state is None:
+            init_state = [cell.default_state(inputs[0, 0]) for cell in cells]
+        if isinstance(init_state[0], tuple):
+            state = tuple(torch.stack([torch.as_tensor(x, device=inputs.device) for x in xs]) for xs in zip(*init_state))
+        else:
+            state = torch.stack(list(init_state))
+        def cell_step(tensors, input, state):
+            return torch.func.functional_call(cells[0], tensors, (input, state))
+        step = torch.func.vmap(cell_step, randomness='different')
+
+        if lengths is not None:
+            lengths = lengths.to(inputs.device)
+        def keep(new, old, t):
+            """ Sequences that have ended keep their state """
+            if new.dim() < 2: # time step shared by the batch
+                return new
+            return torch.where((t < lengths).view(1, -1, *[1]*(new.dim()-2)), new, old)
+
+        # Recurrent dropout as in RNN, with independent masks for the two directions
+        if self.rnn.use_dropout:
+            input_dropout = self.rnn.dropout(torch.ones(inputs.shape[0], inputs.shape[2], inputs.shape[3], device=inputs.device))
+            output_dropout = self.rnn.dropout(torch.ones(2, inputs.shape[2], self.rnn.output_size(), device=inputs.device))
+        outputs = []
+        for t in range(inputs.size(1)):
+            input = inputs[:, t]
+            if self.rnn.use_dropout:
+                input = input * input_dropout
+            output, new_state = step((params, buffers), input, state)
+            if self.rnn.use_dropout:
+                output = output * output_dropout
+                if isinstance(new_state, tuple):
+                    new_state = (self.rnn.dropout(new_state[0]),) + new_state[1:]
+                else:
+                    new_state = self.rnn.dropout(new_state)
+            if lengths is not None:
+                if isinstance(new_state, tuple):
+                    new_state = tuple(keep(x, y, t) for x, y in zip(new_state, state))
+                else:
+                    new_state = keep(new_state, state, t)
+            state = new_state
+            if return_output:
+                if lengths is not None:
+                    output = output * (t < lengths).view(1, -1, 1) # zero padding, as pad_packed_sequence
+                outputs.append(output)
+        states = tuple(apply_tuple(state, lambda x: x[k]) for k in range(2))
+        if return_output:
+            outputs = torch.stack(outputs, dim=1) # (2, length, batch, output_size)
+            outputs = (outputs[0], outputs[1])
+        return outputs, states
+
+    def state_size(self):
+        return 2 * self.rnn.state_size()
+
+    def output_size(self):
+        return 2 * self.rnn.output_size()
+
+    def output(self, state):
+        state_forward, state_reverse = state
+        return torch.cat([self.rnn.output(state_forward), self.rnn.output(state_reverse)], dim=-1)
+
+
 class RNNWrapper(nn.RNN):
 
     def forward(self, inputs, h_0=None):
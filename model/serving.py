@@ -0,0 +1,231 @@
+""" Micro-batching scheduler for serving many concurrent streams with a single recurrent cell.
+
+Each stream (session) owns its own recurrent state (h, m, time_step) and submits one step at a time.
+Instead of calling the cell once per request, the scheduler collects the pending requests of many
+sessions within a latency budget, gathers their states into contiguous batched tensors, runs a single
+batched cell.forward, and scatters the new states and outputs back to the sessions.
+"""
+
+import asyncio
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from model import state_io
+
+
+class Session:
+    """ Recurrent state of a single stream, stored without the batch dimension """
+    def __init__(self, h, m, time_step):
+        self.h = h # (hidden_size,)
+        self.m = m # (memory_size, memory_order)
+        self.time_step = time_step
+
+
+class MicroBatcher:
+    """ Packs single-step requests from many sessions into batched MemoryCell.forward calls.
+
+    cell: a MemoryCell (any cell whose state is a tuple (h, m, time_step))
+    max_batch: maximum number of requests packed into one forward call
+    max_wait: maximum time (in seconds) the first request of a batch waits for more requests to arrive
+    """
+    def __init__(self, cell, max_batch=64, max_wait=1e-3):
+        self.cell = cell.eval()
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.sessions = {}
+        self._ids = itertools.count()
+        self._queue = None
+        self._worker = None
+        # Batches are computed off the event loop so that new requests keep being collected meanwhile
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def open_session(self, session_id=None):
+        """ Create a new stream with the cell's default (zero) state and return its id """
+        if session_id is None:
+            session_id = next(self._ids)
+        assert session_id not in self.sessions, f"session {session_id} already exists"
+        p = next(self.cell.parameters())
+        h, m, time_step = self.cell.default_state(p.new_empty((1, self.cell.input_size)))
+        self.sessions[session_id] = Session(h[0], m[0], time_step)
+        return session_id
+
+    def close_session(self, session_id):
+        del self.sessions[session_id]
+
+    def save(self, path, m_dtype=None):
+        """ Checkpoint the state of all sessions (see model.state_io); session ids must be integers """
+        ids = list(self.sessions)
+        assert all(isinstance(session_id, int) for session_id in ids), "MicroBatcher.save: session ids must be integers"
+        sessions = [self.sessions[session_id] for session_id in ids]
+        if not sessions:
+            # An empty checkpoint, with the shapes of the cell's state
+            p = next(self.cell.parameters())
+            h, m, _ = self.cell.default_state(p.new_empty((1, self.cell.input_size)))
+            state = (h[:0], m[:0], torch.zeros(0, dtype=torch.int64))
+        else:
+            state = (torch.stack([s.h for s in sessions], dim=0),
+                     torch.stack([s.m for s in sessions], dim=0),
+                     torch.stack([torch.as_tensor(s.time_step) for s in sessions], dim=0))
+        state_io.save_state_file(path, state, ids, m_dtype=m_dtype)
+
+    def restore(self, path):
+        """ Load sessions from a checkpoint; the states are views of the memory-mapped file """
+        (h, m, time_step), ids = state_io.load_state_file(path)
+        _, m_, _ = self.cell.default_state(h[:1])
+        if m.dtype != m_.dtype:
+            # e.g. a float16 checkpoint restored into a float32 or int8 cell
+            m = self.cell.store_memory(self.cell.load_memory(m))
+        for i, session_id in enumerate(ids.tolist()):
+            self.sessions[session_id] = Session(h[i], m[i], time_step[i])
+        # New sessions get ids after the restored ones
+        self._ids = itertools.count(max((i for i in self.sessions if isinstance(i, int)), default=-1) + 1)
+
+    def start(self):
+        """ Start the batching loop on the running event loop """
+        assert self._worker is None, "MicroBatcher already started"
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.get_event_loop().create_task(self._loop())
+
+    async def stop(self):
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    async def step(self, session_id, input):
+        """ Advance one stream by one step
+
+        input: (input_size,)
+        Returns the cell output for this stream, (output_size,)
+        """
+        assert self._worker is not None, "MicroBatcher.step: call start() first"
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((session_id, input, future))
+        return await future
+
+    async def _collect(self):
+        """ Wait for a first request, then gather more until max_batch or max_wait is reached """
+        requests = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(requests) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return requests
+
+    def _drain(self):
+        """ The requests already queued, without waiting """
+        requests = []
+        while len(requests) < self.max_batch and not self._queue.empty():
+            requests.append(self._queue.get_nowait())
+        return requests
+
+    def _partition(self, requests):
+        """ Split off the requests that can share one forward call
+
+        A session can only be advanced once per call, so repeated requests of the same session are deferred.
+        Requests of unknown sessions fail on their own, without failing the rest of the batch,
+        and cancelled requests are dropped.
+        """
+        batch, deferred, seen = [], [], set()
+        for request in requests:
+            if request[2].done():
+                continue # cancelled by the client, e.g. on a timeout
+            if request[0] not in self.sessions:
+                request[2].set_exception(KeyError(f"MicroBatcher: unknown session {request[0]}"))
+            elif request[0] in seen:
+                deferred.append(request)
+            else:
+                seen.add(request[0])
+                batch.append(request)
+        return batch, deferred
+
+    def _forward(self, requests):
+        """ Gather the states of the requested sessions, run one batched step, and scatter the results back """
+        sessions = [self.sessions[session_id] for session_id, _, _ in requests]
+        input = torch.stack([input for _, input, _ in requests], dim=0)
+        h = torch.stack([s.h for s in sessions], dim=0)
+        m = torch.stack([s.m for s in sessions], dim=0)
+        # Sessions may be at different positions, so time steps are packed into a per-sample tensor,
+        # unless they are all at the same one, which takes the faster path of a shared time step
+        time_step = torch.stack([torch.as_tensor(s.time_step) for s in sessions], dim=0)
+        if bool((time_step == time_step[0]).all()):
+            time_step = time_step[0].item()
+        with torch.no_grad():
+            output, (h, m, time_step) = self.cell(input, (h, m, time_step))
+        for i, s in enumerate(sessions):
+            s.h, s.m = h[i], m[i]
+            s.time_step = time_step[i] if isinstance(time_step, torch.Tensor) else time_step
+        return output
+
+    async def _loop(self):
+        loop = asyncio.get_event_loop()
+        deferred = []
+        while True:
+            # Deferred requests are already waiting: they are served right away, with whatever else is queued
+            requests = deferred + (self._drain() if deferred else await self._collect())
+            batch, deferred = self._partition(requests)
+            if not batch:
+                continue
+            try:
+                output = await loop.run_in_executor(self._executor, self._forward, batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            # A request cancelled during the forward call has still advanced its session
+            for i, (_, _, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(output[i])
+
+
+
+### Benchmark
+
+async def _load(batcher, nsessions, nsteps, input_size):
+    """ Local load generator: each session issues nsteps sequential requests """
+    latencies = []
+
+    async def client(session_id):
+        for _ in range(nsteps):
+            x = torch.randn(input_size)
+            start = time.perf_counter()
+            await batcher.step(session_id, x)
+            latencies.append(time.perf_counter() - start)
+
+    sessions = [batcher.open_session() for _ in range(nsessions)]
+    batcher.start()
+    start = time.perf_counter()
+    await asyncio.gather(*[client(s) for s in sessions])
+    elapsed = time.perf_counter() - start
+    await batcher.stop()
+    return np.array(latencies), elapsed
+
+
+def benchmark(nsessions=256, nsteps=50, hidden_size=256, memory_order=256):
+    from model.opcell import LegendreScaleCell
+    torch.set_num_threads(1)
+    input_size = 1
+    for max_batch, max_wait in [(1, 0.), (16, 1e-3), (64, 2e-3), (256, 5e-3)]:
+        cell = LegendreScaleCell(input_size, hidden_size, memory_order=memory_order, max_length=nsteps)
+        batcher = MicroBatcher(cell, max_batch=max_batch, max_wait=max_wait)
+        latencies, elapsed = asyncio.run(_load(batcher, nsessions, nsteps, input_size))
+        print(f"max_batch={max_batch:4d} max_wait={max_wait*1e3:.1f}ms: "
+              f"p50 {np.percentile(latencies, 50)*1e3:.2f}ms, "
+              f"p99 {np.percentile(latencies, 99)*1e3:.2f}ms, "
+              f"throughput {len(latencies)/elapsed:.0f} steps/s")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,146 @@
+""" Compact binary format for the recurrent state (h, m, time_step) of MemoryCell streams.
+
+Layout (little endian):
+  header: 60 bytes, see HEADER below
+  h:      (B, hidden_size) float32
+  m:      (B, memory_size, memory_order) float32, float16, bfloat16 or int8 (see MemoryCell.memory_dtype)
+  t:      (B,) int64 or float64 time steps (integer steps or timestamps)
+  ids:    (B,) int64 stream ids, optional
+Every buffer starts at a multiple of ALIGN bytes, so that loading is a zero-copy torch.frombuffer over the file.
+"""
+
+import mmap
+import struct
+
+import torch
+
+
+MAGIC = b'HIPPOST\0'
+VERSION = 1
+ALIGN = 64
+# magic, version, m dtype, t dtype, has_ids, batch, hidden_size, memory_size, memory_order
+HEADER = struct.Struct('<8sIIII4xQQQQ')
+
+dtype_codes = {
+    torch.float32: 0,
+    torch.float16: 1,
+    torch.bfloat16: 2,
+    torch.int64: 3,
+    torch.float64: 4,
+    torch.int8: 5,
+}
+code_dtypes = {v: k for k, v in dtype_codes.items()}
+
+
+def padding(offset):
+    """ Number of bytes from offset to the next multiple of ALIGN """
+    return -offset % ALIGN
+
+def write_tensor(f, offset, x):
+    """ Write the raw bytes of x at the next aligned position, return the new offset """
+    pad = padding(offset)
+    f.write(b'\0' * pad)
+    # Viewing as bytes also covers dtypes that numpy does not support, e.g. bfloat16
+    data = x.detach().contiguous().cpu().view(-1).view(torch.uint8).numpy()
+    f.write(data)
+    return offset + pad + data.nbytes
+
+def read_tensor(buffer, offset, dtype, shape):
+    """ View of the tensor written by write_tensor at offset, return it and the offset after it """
+    offset += padding(offset)
+    count = 1
+    for s in shape:
+        count *= s
+    if count == 0:
+        x = torch.empty(shape, dtype=dtype)
+    else:
+        x = torch.frombuffer(buffer, dtype=dtype, count=count, offset=offset).view(shape)
+    return x, offset + count * x.element_size()
+
+
+def save_state(f, state, ids=None, m_dtype=None):
+    """ Write a batched state to a binary file object
+
+    state: (h, m, time_step) with h (B, H), m (B, M, N) and time_step an int or a (B,) tensor
+    ids: optional (B,) integer stream ids
+    m_dtype: storage type of m, defaults to the type of m; float16/bfloat16 halve the size of the largest buffer
+    """
+    h, m, time_step = state
+    if m_dtype is None:
+        m_dtype = m.dtype
+    assert m.dtype == m_dtype or (m.is_floating_point() and m_dtype != torch.int8), \
+        f"save_state: cannot convert memory of type {m.dtype} to {m_dtype}"
+    B, M, N = m.shape
+    H = h.shape[-1]
+    if not isinstance(time_step, torch.Tensor):
+        time_step = torch.full((B,), time_step, dtype=torch.int64)
+    t_dtype = torch.float64 if time_step.is_floating_point() else torch.int64
+
+    f.write(HEADER.pack(MAGIC, VERSION, dtype_codes[m_dtype], dtype_codes[t_dtype], int(ids is not None), B, H, M, N))
+    offset = HEADER.size
+    offset = write_tensor(f, offset, h.float())
+    offset = write_tensor(f, offset, m.to(m_dtype))
+    offset = write_tensor(f, offset, time_step.to(t_dtype).expand(B))
+    if ids is not None:
+        offset = write_tensor(f, offset, torch.as_tensor(ids, dtype=torch.int64))
+    return offset
+
+
+def load_state(buffer):
+    """ Read a batched state from a buffer without copying
+
+    buffer: any writable object supporting the buffer protocol, e.g. a bytearray or a copy-on-write mmap
+    Returns (h, m, time_step), ids. m keeps its storage type; ids is None if they were not saved.
+    """
+    magic, version, m_code, t_code, has_ids, B, H, M, N = HEADER.unpack_from(buffer, 0)
+    assert magic == MAGIC, "load_state: not a HiPPO state file"
+    assert version == VERSION, f"load_state: unsupported version {version}"
+    offset = HEADER.size
+    h, offset = read_tensor(buffer, offset, torch.float32, (B, H))
+    m, offset = read_tensor(buffer, offset, code_dtypes[m_code], (B, M, N))
+    time_step, offset = read_tensor(buffer, offset, code_dtypes[t_code], (B,))
+    ids = None
+    if has_ids:
+        ids, offset = read_tensor(buffer, offset, torch.int64, (B,))
+    return (h, m, time_step), ids
+
+
+def save_state_file(path, state, ids=None, m_dtype=None):
+    with open(path, 'wb') as f:
+        return save_state(f, state, ids, m_dtype)
+
+def load_state_file(path):
+    """ Memory-map a state file; the returned tensors are views of the mapping """
+    with open(path, 'rb') as f:
+        # Copy-on-write mapping: writable for torch.frombuffer, but never modifies the file
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return load_state(buffer)
+
+
+
+### Benchmark
+
+def benchmark(nsessions=100000, hidden_size=256, memory_order=256, path='/tmp/hippo_state.bin'):
+    import time
+    h = torch.randn(nsessions, hidden_size)
+    m = torch.randn(nsessions, 1, memory_order)
+    t = torch.randint(0, 1000, (nsessions,))
+    ids = torch.arange(nsessions)
+    nbytes = (h.numel() + m.numel()) * 4
+    for m_dtype in [torch.float32, torch.float16, torch.bfloat16]:
+        start = time.perf_counter()
+        save_state_file(path, (h, m, t), ids, m_dtype=m_dtype)
+        save_time = time.perf_counter() - start
+        start = time.perf_counter()
+        (h_, m_, t_), _ = load_state_file(path)
+        m_ = m_.float()
+        load_time = time.perf_counter() - start
+        print(f"{m_dtype}: save {save_time:.3f}s ({nbytes/save_time/1e9:.2f} GB/s), load {load_time:.3f}s, "
+              f"max error {(m - m_).abs().max().item():.2e}")
+    start = time.perf_counter()
+    torch.save([(h[i], m[i], t[i].item()) for i in range(nsessions)], path)
+    print(f"torch.save of per-session tuples: {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == '__main__':
+    benchmark()
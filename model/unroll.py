@@ -408,6 +408,18 @@ def variable_unroll_matrix(A, u, s=None, variable=True, recurse_limit=16):
     matmul = lambda x, y: x @ y
     return variable_unroll_general(A, u, s, op, compose_op=matmul, sequential_op=sequential_op, variable=variable, recurse_limit=recurse_limit)
 
+def variable_unroll_diagonal(A, u, s=None, variable=True, recurse_limit=16):
+    """ Unroll with elementwise (diagonal) transitions: x[i] = A[i] * x[i-1] + u[i]
+
+    A : ([L], ..., N) dimension L should exist iff variable is True
+    u : (L, ..., N) updates
+    s : (..., N) start state
+    """
+    if s is None:
+        s = torch.zeros_like(u[0])
+    mult = lambda x, y: x * y
+    return variable_unroll_general(A, u, s, mult, variable=variable, recurse_limit=recurse_limit)
+
 # @profile
 def variable_unroll_toeplitz(A, u, s=None, variable=True, recurse_limit=8, pad=False):
     """ Unroll with variable (in time/length) transitions A with general associative operation
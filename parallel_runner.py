@@ -0,0 +1,124 @@
+""" Runs several trials concurrently on one machine
+
+The trials are the runner.ntrials seeds of every point of the grid runner.grid, e.g.
+  runner.grid='{train.lr: [1e-3, 1e-4], model.cell: [legs, legt]}'
+They are executed by a pool of runner.nworkers processes, each pinned to its own share of the cores
+(os.sched_setaffinity and torch.set_num_threads), or to its own GPU when there are GPUs.
+The dataset is built once before the pool is forked, so the trials share it (see datasets.dataset_cache).
+The final metrics of every trial are collected into the CSV file runner.results, or the error of a failed trial.
+"""
+
+import csv
+import itertools
+import multiprocessing as mp
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+from omegaconf import OmegaConf
+from pytorch_lightning.loggers import CSVLogger
+
+from datasets import DatasetBase, dataset_cache
+from pl_runner import pl_train
+from utils import to_scalar
+
+
+def grid_points(grid):
+    """ {key: [values]} -> list of {key: value}, the cartesian product of the values """
+    if not grid:
+        return [{}]
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[list(grid[k]) for k in keys])]
+
+def trial_configs(cfg):
+    """ (trial, overrides, cfg) for every seed of every point of the grid """
+    seed = cfg.seed if cfg.seed is not None else 0
+    trials = []
+    for overrides in grid_points(cfg.runner.get('grid', None)):
+        for i in range(cfg.runner.ntrials):
+            trial_cfg = OmegaConf.create(OmegaConf.to_container(cfg))
+            OmegaConf.set_struct(trial_cfg, False)
+            for key, value in overrides.items():
+                OmegaConf.update(trial_cfg, key, value)
+            trial_cfg.seed = seed + i
+            # Every trial is a single process, which leaves the parallelism to the pool
+            trial_cfg.runner.gpus = 1 if torch.cuda.is_available() else 0
+            trial_cfg.runner.num_processes = 1
+            trial_cfg.runner.num_nodes = 1
+            trial_cfg.dataset.num_workers = cfg.runner.get('loader_workers', 0)
+            trials.append((len(trials), overrides, trial_cfg))
+    return trials
+
+
+_slot = None
+
+def _init_worker(slots):
+    """ Pins the worker to the cores (and GPU) of a free slot """
+    global _slot
+    _slot = slots.get()
+    cores, gpu = _slot
+    if gpu is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+def _run_trial(trial, cfg_container, pl_model_class):
+    cfg = OmegaConf.create(cfg_container)
+    logger = CSVLogger("logs", name="my_model", version=f"trial_{trial}")
+    trainer, _ = pl_train(cfg, pl_model_class, logger=logger)
+    return {k: to_scalar(v) for k, v in trainer.callback_metrics.items()}
+
+
+def parallel_train(cfg, pl_model_class):
+    trials = trial_configs(cfg)
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    ngpus = torch.cuda.device_count()
+    nworkers = cfg.runner.get('nworkers', 0) or min(len(trials), ngpus or len(cores))
+    nworkers = max(1, min(nworkers, len(trials)))
+    threads = cfg.runner.get('threads_per_trial', 0) or max(1, len(cores) // nworkers)
+
+    # Build the datasets before forking, so that the workers share them instead of each building its own
+    for _, _, trial_cfg in trials:
+        key = OmegaConf.to_yaml(trial_cfg.dataset)
+        if key not in dataset_cache:
+            dataset = DatasetBase.registry[trial_cfg.dataset.name](trial_cfg.dataset)
+            dataset.prepare_data()
+            dataset_cache[key] = dataset
+
+    # Fork (not spawn): the workers inherit the dataset cache copy-on-write. The parent must not have initialized CUDA
+    context = mp.get_context('fork')
+    slots = context.Queue()
+    for w in range(nworkers):
+        slot_cores = [cores[(w * threads + j) % len(cores)] for j in range(threads)]
+        slots.put((slot_cores, w % ngpus if ngpus > 0 else None))
+
+    path = cfg.runner.get('results', 'results.csv')
+    results = []
+    with ProcessPoolExecutor(nworkers, mp_context=context, initializer=_init_worker, initargs=(slots,)) as pool:
+        futures = {pool.submit(_run_trial, trial, OmegaConf.to_container(trial_cfg), pl_model_class): (trial, overrides, trial_cfg)
+                   for trial, overrides, trial_cfg in trials}
+        for future in as_completed(futures):
+            trial, overrides, trial_cfg = futures[future]
+            row = {'trial': trial, 'seed': trial_cfg.seed, **overrides}
+            # A failed trial is recorded with its error, and does not stop the collection of the others
+            try:
+                row.update(future.result())
+                print(f"trial {trial} done:", row)
+            except Exception as e:
+                row['error'] = f"{type(e).__name__}: {e}"
+                print(f"trial {trial} failed:", row)
+                traceback.print_exception(type(e), e, e.__traceback__)
+            results.append(row)
+            write_results(path, results)
+    return results
+
+def write_results(path, results):
+    """ One row per trial, ordered by trial; the columns are the union of the keys of the rows """
+    results = sorted(results, key=lambda row: row['trial'])
+    fields = list(dict.fromkeys(k for row in results for k in row))
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
@@ -2,19 +2,77 @@ import torch
 import pytorch_lightning as pl
 from pytorch_lightning.loggers import CSVLogger
 
+from model import profiling
+
 csv_logger = CSVLogger("logs", name="my_model")
 
-def pl_train(cfg, pl_model_class):
-    if cfg.seed is not None:
-        torch.manual_seed(cfg.seed)
-        if torch.cuda.is_available():
-            torch.cuda.manual_seed(cfg.seed)
+
+class ComponentTimer(pl.Callback):
+    """ Aggregates the wall time of the model components (see model.profiling) over each training epoch and logs it """
+
+    def on_train_epoch_start(self, trainer, pl_module, *args):
+        profiling.reset()
+
+    def on_train_batch_start(self, trainer, pl_module, *args):
+        profiling.config.timing = True
+
+    def on_train_batch_end(self, trainer, pl_module, *args):
+        profiling.config.timing = False
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        summary = profiling.summary()
+        total = sum(seconds for seconds, _ in summary.values())
+        metrics = {}
+        for name, (seconds, calls) in summary.items():
+            metrics[f'time_{name}'] = seconds
+            metrics[f'time_{name}_frac'] = seconds / max(total, 1e-12)
+            metrics[f'time_{name}_calls'] = calls
+        if trainer.logger is not None and metrics:
+            trainer.logger.log_metrics(metrics, step=trainer.global_step)
+
+def distributed_args(runner_cfg):
+    """ Trainer arguments for data-parallel training
+
+    runner.gpus GPUs per node (-1: all of them), or runner.num_processes processes per node with runner.gpus=0,
+    on runner.num_nodes nodes. More than one process in total trains with DDP, over NCCL on GPUs and gloo on CPUs
+    (the backend can be overridden with the PL_TORCH_DISTRIBUTED_BACKEND environment variable).
+    """
+    gpus = runner_cfg.get('gpus', None)
+    if gpus is None:
+        gpus = 1 if torch.cuda.is_available() else 0
+    num_nodes = runner_cfg.get('num_nodes', 1)
+    num_processes = runner_cfg.get('num_processes', 1)
+    if gpus == -1:
+        gpus = torch.cuda.device_count()
+    if gpus > 0:
+        args = {'gpus': gpus, 'num_nodes': num_nodes}
+        world_size = gpus * num_nodes
+        accelerator = 'ddp'
+    else:
+        args = {'gpus': 0, 'num_nodes': num_nodes, 'num_processes': num_processes}
+        world_size = num_processes * num_nodes
+        accelerator = 'ddp_cpu'
+    if world_size > 1:
+        # The DatasetBase loaders are sharded by the model (see RNNTraining.prepare_dataloader)
+        args.update(accelerator=accelerator, replace_sampler_ddp=False)
+    return args, world_size
+
+def pl_train(cfg, pl_model_class, logger=None):
+    distributed, world_size = distributed_args(cfg.runner)
+    if cfg.seed is not None or world_size > 1:
+        # Also exported as PL_GLOBAL_SEED to the DDP processes, which all draw the same data from it
+        pl.seed_everything(cfg.seed if cfg.seed is not None else 0)
     model = pl_model_class(cfg.model, cfg.dataset, cfg.train)
     if 'pl' in cfg and 'profile' in cfg.pl and cfg.pl.profile:
         # profiler=pl.profiler.AdvancedProfiler(output_filename=cfg.train.profiler),
         profiler_args = { 'profiler': pl.profiler.AdvancedProfiler(), }
     else:
         profiler_args = {}
+    callbacks = []
+    if 'pl' in cfg and 'profile_components' in cfg.pl and cfg.pl.profile_components:
+        # record_function ranges show up in torch.profiler traces, wall times are logged per epoch
+        profiling.enable(record=True)
+        callbacks.append(ComponentTimer())
     if 'pl' in cfg and 'wandb' in cfg.pl and cfg.pl.wandb:
         # kwargs['logger'] = WandbLogger(name=config['pl_wandb'], project='ops-memory-pl')
         logger = WandbLogger(project='ops-memory-pl')
@@ -25,17 +83,16 @@ def pl_train(cfg, pl_model_class):
     print("profiler args", profiler_args)
     
     trainer = pl.Trainer(
-        gpus=1, #repo 자체가 multi-GPU 지원 안하는듯
-        # gpus=4, # -1 uses all possible gpus
+        **distributed,
         gradient_clip_val=cfg.train.gradient_clip_val,
         max_epochs=1 if cfg.smoke_test else cfg.train.epochs,
         progress_bar_refresh_rate=1,
         limit_train_batches=cfg.train.limit_train_batches,
         track_grad_norm=2,
-        # distributed_backend='ddp', # for multi-GPU training? 
+        callbacks=callbacks,
         **profiler_args,
         # logger=False,
-        logger=csv_logger,
+        logger=csv_logger if logger is None else logger,
     )
 
     trainer.fit(model)
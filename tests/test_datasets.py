@@ -0,0 +1,158 @@
+import importlib.util
+import os
+import pickle
+import tempfile
+import unittest
+
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from datasets import DatasetBase, CustomTransform, PermuteTransform, utils
+from datasets.copying import copying_stream_dataset
+
+
+class ByteImageDatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_matches_transforms(self):
+        images = torch.randint(0, 256, (20, 28, 28), dtype=torch.uint8)
+        targets = torch.randint(0, 10, (20,))
+        permutation = utils.bitreversal_permutation(784)
+        transform = transforms.Compose([transforms.ToTensor(), CustomTransform(1, 784), PermuteTransform(permutation)])
+        expected = torch.stack([transform(Image.fromarray(image.numpy(), mode='L')) for image in images])
+        with tempfile.TemporaryDirectory() as directory:
+            paths = utils.cache_byte_images(f'{directory}/train', images, targets, permutation)
+            data = DatasetBase(None)
+            data.train = utils.ByteImageDataset(paths).subset(torch.arange(15))
+            data.val = data.test = utils.ByteImageDataset(paths).subset(torch.arange(15, 20))
+            data.prepare_dataloader(8, num_workers=4)
+            batches = list(data.train_loader)
+            self.assertEqual([len(x) for x, _ in batches], [8, 7])
+            inputs, labels = map(torch.cat, zip(*batches))
+            # The training batches are shuffled, the others are in order
+            order = torch.tensor([next(i for i in range(15) if torch.equal(x, expected[i])) for x in inputs])
+            self.assertEqual(sorted(order.tolist()), list(range(15)))
+            self.assertTrue(torch.equal(labels, targets[order]))
+            x, y = next(iter(data.test_loader))
+            self.assertTrue(torch.equal(x, expected[15:]))
+            self.assertTrue(torch.equal(y, targets[15:]))
+
+    def test_sharded_epochs(self):
+        images = torch.randint(0, 256, (40, 28, 28), dtype=torch.uint8)
+        targets = torch.arange(40)
+        with tempfile.TemporaryDirectory() as directory:
+            paths = utils.cache_byte_images(f'{directory}/train', images, targets)
+            data = DatasetBase(None)
+            data.train = data.val = data.test = utils.ByteImageDataset(paths)
+            epochs = []
+            for epoch in range(2):
+                shards = []
+                for rank in range(2):
+                    data.prepare_dataloader(8, num_replicas=2, rank=rank)
+                    # As Lightning does at the start of every epoch
+                    data.train_loader.sampler.set_epoch(epoch)
+                    shards.append(torch.cat([y for _, y in data.train_loader]).tolist())
+                self.assertEqual(sorted(shards[0] + shards[1]), list(range(40)))
+                epochs.append(shards)
+            # Every epoch shuffles differently
+            self.assertNotEqual(epochs[0][0], epochs[1][0])
+
+
+class StreamDatasetTest(unittest.TestCase):
+
+    def stream(self, samples=50):
+        return copying_stream_dataset(20, 4, 6, True, samples, seed=3, one_hot=False)
+
+    def batches(self, dataset, batch_size=8, **kwargs):
+        dataset.batch_size = batch_size
+        return list(torch.utils.data.DataLoader(dataset, batch_size=None, **kwargs))
+
+    def assertBatchesEqual(self, batches, expected):
+        self.assertEqual(len(batches), len(expected))
+        for (x, y), (x_, y_) in zip(batches, expected):
+            self.assertTrue(torch.equal(x, x_) and torch.equal(y, y_))
+
+    def test_workers(self):
+        batches = self.batches(self.stream())
+        self.assertEqual(sum(len(x) for x, _ in batches), 50)
+        # The workers interleave their batches, which come back in the order of the batch indices
+        self.assertBatchesEqual(self.batches(self.stream(), num_workers=2), batches)
+
+    def test_shards(self):
+        batches = self.batches(self.stream())
+        shards = []
+        for rank in range(3):
+            stream = self.stream()
+            stream.shard(rank, 3)
+            shards.append(dict(zip(stream.batches(), self.batches(stream))))
+        indices = [i for shard in shards for i in shard]
+        self.assertEqual(sorted(indices), list(range(len(batches))))
+        self.assertBatchesEqual([next(shard[i] for shard in shards if i in shard) for i in range(len(batches))], batches)
+
+    def test_epochs(self):
+        stream = self.stream()
+        stream.batch_size = 8
+        loader = utils.EpochLoader(torch.utils.data.DataLoader(stream, batch_size=None))
+        first, second = list(loader), list(loader)
+        self.assertFalse(any(torch.equal(x, x_) for (x, _), (x_, _) in zip(first, second)))
+        # Each epoch is reproducible
+        stream.set_epoch(1)
+        self.assertBatchesEqual(self.batches(stream), second)
+        with self.assertRaises(AssertionError):
+            utils.EpochLoader(torch.utils.data.DataLoader(stream, batch_size=None, num_workers=1, persistent_workers=True))
+
+
+class SharedDatasetTest(unittest.TestCase):
+
+    def test_mmap_reuses_files(self):
+        x, y = torch.randn(300, 64), torch.arange(300)
+        with tempfile.TemporaryDirectory() as directory:
+            train, val = torch.utils.data.random_split(torch.utils.data.TensorDataset(x, y), [200, 100])
+            train, val = utils.share_datasets([train, val], 'mmap', directory)
+            self.assertIs(train.dataset, val.dataset)
+            # Another process building the same data maps the same files
+            shared, = utils.share_datasets([torch.utils.data.TensorDataset(x.clone(), y.clone())], 'mmap', directory)
+            self.assertEqual(shared.paths, train.dataset.paths)
+            self.assertEqual(len(os.listdir(directory)), 2)
+            # Workers receive the paths, not the data
+            pickled = pickle.dumps(train)
+            self.assertLess(len(pickled), x.nbytes // 10)
+            train_ = pickle.loads(pickled)
+            self.assertEqual(train_.dataset.paths, train.dataset.paths)
+            self.assertTrue(torch.equal(torch.stack([train_[i][0] for i in range(200)]), x[train.indices]))
+            del train, val, shared, train_
+
+
+class DataParallelTest(unittest.TestCase):
+
+    def test_sharded_loaders(self):
+        num_replicas = 3
+        data = DatasetBase(None)
+        data.train = torch.utils.data.TensorDataset(torch.arange(20))
+        data.val = torch.utils.data.TensorDataset(torch.arange(100, 107))
+        data.test = torch.utils.data.TensorDataset(torch.arange(200, 205))
+        shards = {'train': [], 'val': [], 'test': []}
+        for rank in range(num_replicas):
+            data.prepare_dataloader(4, num_replicas=num_replicas, rank=rank)
+            for name, loader in [('train', data.train_loader), ('val', data.val_loader), ('test', data.test_loader)]:
+                shards[name].append(torch.cat([x for x, in loader]).tolist())
+        for name, split in [('train', data.train), ('val', data.val), ('test', data.test)]:
+            # Every rank gets the same number of samples (DistributedSampler pads with repeated samples), which together cover the split
+            self.assertEqual(len(set(map(len, shards[name]))), 1)
+            samples = sum(shards[name], [])
+            self.assertEqual(set(samples), set(split.tensors[0].tolist()))
+            self.assertLess(len(samples), len(split) + num_replicas)
+
+    @unittest.skipUnless(importlib.util.find_spec('pytorch_lightning'), "pytorch_lightning is not installed")
+    def test_distributed_args(self):
+        from pl_runner import distributed_args
+        args, world_size = distributed_args({'gpus': 0, 'num_processes': 4, 'num_nodes': 2})
+        self.assertEqual(world_size, 8)
+        self.assertEqual(args['accelerator'], 'ddp_cpu')
+        self.assertFalse(args['replace_sampler_ddp'])
+        args, world_size = distributed_args({'gpus': 0, 'num_processes': 1, 'num_nodes': 1})
+        self.assertEqual(world_size, 1)
+        self.assertNotIn('accelerator', args)
@@ -0,0 +1,151 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from scipy import special as ss
+import torch
+
+from model.hippo import HiPPO_LegS, HiPPO_LegT, VariableMemoryProjection
+from model.model import Model
+from model.op import DPLRTransition, transition
+from model import codec
+
+
+class VariableMemoryProjectionTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.rtol = 1e-4
+        self.atol = 1e-4
+
+    def test_matches_sequential(self):
+        length, batch_size, channels, order = 100, 4, 3, 16
+        inputs = torch.randn(length, batch_size, channels)
+        for measure in ['legs', 'legt']:
+            projection = VariableMemoryProjection(order=order, measure=measure, max_length=length)
+            out = projection(inputs)
+            self.assertEqual(out.shape, (length, batch_size, channels, order))
+            for c in range(channels):
+                expected = projection.hippo(inputs[:, :, c], engine='sequential')
+                self.assertTrue(torch.allclose(out[:, :, c], expected, rtol=self.rtol, atol=self.atol))
+
+    def test_model_preprocess_bank(self):
+        length, batch_size, channels, order = 20, 3, 2, 4
+        dts = [0.1, 0.01]
+        model = Model(channels, 5, cell='legt', cell_args={'hidden_size': 8},
+                      preprocess={'order': order, 'measure': 'legt', 'dt': dts})
+        rnn_inputs = []
+        model.rnn.register_forward_pre_hook(lambda module, args: rnn_inputs.append(args[0]))
+        inputs = torch.randn(batch_size, length, channels)
+        self.assertEqual(model(inputs).shape, (batch_size, 5))
+        # The inputs, followed by the projections of every channel onto every window
+        features = rnn_inputs[0]
+        self.assertEqual(features.shape, (length, batch_size, channels * (len(dts) * order + 1)))
+        x = inputs.transpose(0, 1)
+        self.assertTrue(torch.equal(features[..., :channels], x))
+        p = features[..., channels:].view(length, batch_size, channels, len(dts), order)
+        for k, dt in enumerate(dts):
+            expected = VariableMemoryProjection(order=order, measure='legt', dt=dt)(x)
+            self.assertTrue(torch.allclose(p[..., k, :], expected, rtol=self.rtol, atol=self.atol))
+
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.rtol = 1e-4
+        self.atol = 1e-4
+
+    def test_engines_match_sequential(self):
+        length, order = 80, 16
+        inputs = torch.randn(length, 3, 2)
+        for module in [HiPPO_LegS(order, max_length=length), HiPPO_LegT(order, dt=1./length)]:
+            expected = module(inputs, engine='sequential')
+            self.assertIn(module.select_engine(inputs), module.engines)
+            for engine in module.engines:
+                if engine == 'cpp' and not module.cpp_supported(inputs):
+                    continue
+                out = module(inputs, engine=engine)
+                self.assertEqual(out.shape, (length, 3, 2, order))
+                self.assertTrue(torch.allclose(out, expected, rtol=self.rtol, atol=self.atol), engine)
+
+    def test_legt_bank(self):
+        length, order = 80, 16
+        dts = [1./8, 1./32, 1./length]
+        inputs = torch.randn(length, 3, 2)
+        bank = HiPPO_LegT(order, dt=dts)
+        expected = torch.stack([HiPPO_LegT(order, dt=dt)(inputs, engine='sequential') for dt in dts], dim=-2)
+        for engine in bank.engines:
+            out = bank(inputs, engine=engine)
+            self.assertEqual(out.shape, (length, 3, 2, len(dts), order))
+            self.assertTrue(torch.allclose(out, expected, rtol=self.rtol, atol=self.atol), engine)
+
+
+class ReconstructTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.atol = 1e-4
+
+    def test_matches_table(self):
+        length, order = 200, 32
+        inputs = torch.randn(length, 2)
+        for module, scale, sign in [(HiPPO_LegS(order, max_length=length), np.sqrt(2 * np.arange(order) + 1), 1.),
+                                    (HiPPO_LegT(order, dt=1./length), np.ones(order), -1.)]:
+            c = module(inputs)
+            vals = np.linspace(0.0, 1.0, 37)
+            table = torch.Tensor((scale[:, None] * ss.eval_legendre(np.arange(order)[:, None], sign * (2 * vals - 1))).T) # (Q, N)
+            expected = (table @ c.unsqueeze(-1)).squeeze(-1)
+            out = module.reconstruct(c, vals=torch.Tensor(vals))
+            self.assertEqual(out.shape, (length, 2, len(vals)))
+            self.assertTrue(torch.allclose(out, expected, atol=self.atol * expected.abs().max()))
+            self.assertTrue(torch.allclose(module.reconstruct(c, last=True), module.reconstruct(c)[-1]))
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        length, channels, order, segment = 1000, 3, 16, 128
+        t = torch.linspace(0, 1, length).unsqueeze(-1)
+        f = torch.sin(2 * np.pi * t * torch.tensor([1., 2., 3.]))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'signal.bin')
+            for measure in ['legs', 'legt']:
+                # The final coefficients of each segment are those of the module restarted at the segment
+                codec.encode(f, path, order=order, segment=segment, measure=measure, dtype=torch.float32, chunk_segments=3)
+                decoder = codec.Decoder(path)
+                expected = codec.hippo_module(measure, order, segment)(f[:segment], engine='sequential')[-1]
+                self.assertTrue(torch.allclose(decoder.coefficients(0, 1)[0], expected, atol=1e-4))
+                out = decoder.decode()
+                self.assertEqual(out.shape, f.shape)
+                self.assertLess((out - f).pow(2).mean().sqrt().item(), 0.1)
+                # Partial ranges across chunk and segment boundaries, including the shorter last segment
+                for start, stop in [(0, 1), (100, 500), (383, 384), (900, 1000), (950, 2000)]:
+                    self.assertTrue(torch.allclose(decoder.decode(start, stop), out[start:stop], atol=1e-5))
+                codec.encode(f, path, order=order, segment=segment, measure=measure, dtype=torch.float16)
+                self.assertTrue(torch.allclose(codec.decode(path), out, atol=1e-2))
+
+
+class DPLRTransitionTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.atol = 1e-5
+
+    def test_bilinear(self):
+        N, L, dt = 16, 100, 0.01
+        for measure in ['legs', 'legt', 'lagt', 'lmu']:
+            A, B = transition(measure, N)
+            I = np.eye(N)
+            dA = torch.tensor(np.linalg.solve(I - dt/2 * A, I + dt/2 * A), dtype=torch.float)
+            dB = torch.tensor(np.linalg.solve(I - dt/2 * A, dt * B)[:, 0], dtype=torch.float)
+            T = DPLRTransition(measure, N)
+            x = torch.randn(3, N)
+            v = torch.randn(3)
+            y = T.from_diagonal(T.bilinear(dt, T.to_diagonal(x), v))
+            self.assertTrue(torch.allclose(y, x @ dA.t() + v[:, None] * dB, atol=self.atol))
+            K = [dB]
+            for _ in range(L-1):
+                K.append(dA @ K[-1])
+            self.assertTrue(torch.allclose(T.kernel(dt, L), torch.stack(K), atol=self.atol))
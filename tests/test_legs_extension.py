@@ -174,6 +174,24 @@ class LegSTest(unittest.TestCase):
         mem_np = torch.Tensor(slo(input.cpu().numpy().astype(np.float64), memorder)).double()
         self.assertTrue(torch.allclose(mem, mem_np))
 
+    def test_legs_cell_step(self):
+        from model import opcell
+        batch_size = 4
+        max_length = 8
+        cell = opcell.LegendreScaleCell(3, 16, memory_size=2, memory_order=32, max_length=max_length).eval()
+        inputs = torch.randn(max_length + 3, batch_size, 3)
+        for time_step in [0, torch.tensor([0, 1, 5, max_length + 2])]:
+            with torch.no_grad():
+                state = state_ref = cell.default_state(inputs[0])
+                state = state_ref = (state[0], state[1], time_step)
+                for input in inputs:
+                    self.assertTrue(cell.fusable(input, state))
+                    output, state = cell(input, state)
+                    # Reference: the unfused ATen path
+                    output_ref, state_ref = super(opcell.LegendreScaleCell, cell).forward(input, state_ref)
+                    self.assertTrue(torch.allclose(output, output_ref, atol=1e-5))
+                    self.assertTrue(torch.allclose(state[1], state_ref[1], atol=1e-5))
+
 
 def timeit(fn, nsteps):
     import time
@@ -224,6 +242,19 @@ def benchmark():
     nsteps = 1
     print(f'Function approx trapezoidal C++: {timeit(trap_func_approx_fn, nsteps)}s')
 
+    from model import opcell
+    cell = opcell.LegendreScaleCell(1, 256, memory_order=memorder).eval()
+    nsteps = 1000
+    for batch_size in [1, 4, 8]:
+        input = torch.randn(batch_size, 1)
+        state = cell.default_state(input)
+        state = (state[0], state[1], 10)
+        with torch.no_grad():
+            cell_fn = lambda: cell(input, state)
+            cell_torch_fn = lambda: super(opcell.LegendreScaleCell, cell).forward(input, state)
+            print(f'LegS cell step, batch {batch_size}, fused C++: {timeit(cell_fn, nsteps)}s')
+            print(f'LegS cell step, batch {batch_size}, Pytorch: {timeit(cell_torch_fn, nsteps)}s')
+
 
 if __name__ == "__main__":
     benchmark()
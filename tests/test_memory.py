@@ -0,0 +1,294 @@
+import asyncio
+import io
+import tempfile
+import unittest
+
+import torch
+
+from model.memory import LTICell, TimeLSICell, TimeLTICell
+from model.opcell import LegendreScaleCell, LegendreTranslateCell
+from model.rnn import RNN
+from model.serving import MicroBatcher
+from model import state_io
+
+
+class MemoryCellTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.atol = 1e-5
+
+    def test_lsi_heterogeneous_time_step(self):
+        batch_size = 6
+        memorder = 32
+        max_length = 8
+        cell = LegendreScaleCell(1, 16, memory_order=memorder, max_length=max_length)
+        m = torch.randn(batch_size, 1, memorder)
+        u = torch.randn(batch_size, 1)
+        time_step = torch.tensor([0, 1, 2, 5, max_length, max_length + 3])
+        out = cell.update_memory(m, u, time_step)
+        for i, t in enumerate(time_step.tolist()):
+            out_i = cell.update_memory(m[i:i+1], u[i:i+1], t)
+            self.assertTrue(torch.allclose(out[i:i+1], out_i, atol=self.atol))
+        # A batch at one position takes the path of a shared int time step
+        for t in [0, 3, max_length + 2]:
+            out = cell.update_memory(m, u, torch.full((batch_size,), t))
+            self.assertTrue(torch.allclose(out, cell.update_memory(m, u, t), atol=self.atol))
+
+    def test_tlsi_mixed_batch(self):
+        batch_size = 5
+        memorder = 16
+        cell = TimeLSICell(2, 16, memory_order=memorder)
+        m = torch.randn(batch_size, 1, memorder)
+        u = torch.randn(batch_size, 1)
+        t0 = torch.tensor([0., 0., 1., 2.5, 0.])
+        t1 = torch.tensor([0., 1., 2., 3., 0.])
+        out = cell.update_memory(m, u, t0, t1)
+        for i in range(batch_size):
+            out_i = cell.update_memory(m[i:i+1], u[i:i+1], t0[i:i+1], t1[i:i+1])
+            self.assertTrue(torch.allclose(out[i:i+1], out_i, atol=self.atol))
+        self.assertTrue(torch.equal(out[0, :, 0], u[0]))
+        self.assertTrue(torch.equal(out[0, :, 1:], torch.zeros(1, memorder - 1)))
+
+    def test_tlsi_sparse(self):
+        batch_size = 4
+        length = 12
+        cell = TimeLSICell(3, 16, memory_order=8, sparse=True)
+        inputs = torch.randn(length, batch_size, 3)
+        inputs[:, :, 0] = torch.arange(length, dtype=torch.float).unsqueeze(-1)
+        observed = torch.rand(length, batch_size) < 0.4
+        observed[:, 0] = True # a fully observed row
+        observed[:, 1] = False # a row that is never observed
+        inputs[:, :, 0][~observed] = float('nan')
+        state = cell.default_state(inputs[0])
+        for input in inputs:
+            output, state = cell(input, state)
+        h, m, t = state
+        cell.sparse = False
+        for i in range(batch_size):
+            # Dense steps over the observations of row i only
+            state_i = cell.default_state(inputs[0, i:i+1])
+            for input in inputs[observed[:, i], i:i+1]:
+                _, state_i = cell(input, state_i)
+            self.assertTrue(torch.allclose(h[i:i+1], state_i[0], atol=self.atol))
+            self.assertTrue(torch.allclose(m[i:i+1], state_i[1], atol=self.atol))
+        self.assertTrue(torch.equal(h[1], torch.zeros(16)))
+
+    def test_lti_advance(self):
+        memorder = 16
+        cell = LegendreTranslateCell(1, 16, memory_order=memorder, dt=0.1)
+        m = torch.randn(4, 1, memorder)
+        k = torch.tensor([0, 1, 6, 13])
+        out = cell.advance(m, k)
+        for i, k_i in enumerate(k.tolist()):
+            m_i = m[i:i+1]
+            for _ in range(k_i):
+                m_i = cell.update_memory(m_i, torch.zeros(1, 1), 0)
+            self.assertTrue(torch.allclose(out[i:i+1], m_i, atol=self.atol))
+            self.assertTrue(torch.allclose(cell.advance(m[i:i+1], k_i), m_i, atol=self.atol))
+
+    def test_tlti_idle_steps(self):
+        memorder = 16
+        max_step = 0.5
+        cell = TimeLTICell(2, 16, memory_order=memorder, dt=0.1, max_step=max_step)
+        m = torch.randn(5, 1, memorder)
+        u = torch.randn(5, 1)
+        t0 = torch.tensor([0., 1., 2., 0.5, 3.])
+        t1 = torch.tensor([0.3, 1.5, 4., 3.7, 3.])
+        out = cell.update_memory(m, u, t0, t1)
+        cell.max_step = None
+        for i in range(len(m)):
+            # Explicit idle steps of size max_step, then a last step with the input
+            m_i, t = m[i:i+1], t0[i:i+1]
+            while t1[i] - t > max_step + 1e-6:
+                m_i = cell.update_memory(m_i, torch.zeros(1, 1), t, t + max_step)
+                t = t + max_step
+            m_i = cell.update_memory(m_i, u[i:i+1], t, t1[i:i+1])
+            self.assertTrue(torch.allclose(out[i:i+1], m_i, atol=self.atol))
+        # A bound on the gaps gives the same result
+        cell.max_step, cell.max_gap = max_step, 3.2
+        self.assertTrue(torch.allclose(cell.update_memory(m, u, t0, t1), out, atol=self.atol))
+        # The cached powers follow changes of the step size and of the transition
+        cell.dt = 0.2
+        expected = TimeLTICell(2, 16, memory_order=memorder, dt=0.2, max_step=max_step).update_memory(m, u, t0, t1)
+        self.assertTrue(torch.allclose(cell.update_memory(m, u, t0, t1), expected, atol=self.atol))
+        state = cell.state_dict()
+        state['transition.A'] = 0.5 * state['transition.A']
+        cell.load_state_dict(state)
+        other = TimeLTICell(2, 16, memory_order=memorder, dt=0.2, max_step=max_step)
+        other.load_state_dict(state)
+        self.assertTrue(torch.allclose(cell.update_memory(m, u, t0, t1), other.update_memory(m, u, t0, t1), atol=self.atol))
+
+    def test_lti_bank(self):
+        memorder = 8
+        dts = [0.1, 0.01, 0.001]
+        cell = LegendreTranslateCell(1, 16, memory_order=memorder, dt=dts, discretization='bilinear')
+        cells = [LegendreTranslateCell(1, 16, memory_order=memorder, dt=dt, discretization='bilinear') for dt in dts]
+        self.assertEqual(cell.memory_order, len(dts) * memorder)
+        m = torch.randn(4, 2, len(dts) * memorder)
+        u = torch.randn(4, 2)
+        k = torch.tensor([0, 1, 6, 13])
+        def split(x):
+            return x.split(memorder, dim=-1)
+        out = cell.update_memory(m, u, 0)
+        out_k = cell.advance(m, k)
+        K = cell.kernel(20)
+        for c, m_c, out_c, out_k_c, K_c in zip(cells, split(m), split(out), split(out_k), split(K)):
+            self.assertTrue(torch.allclose(out_c, c.update_memory(m_c, u, 0), atol=self.atol))
+            self.assertTrue(torch.allclose(out_k_c, c.advance(m_c, k), atol=self.atol))
+            self.assertTrue(torch.allclose(K_c, c.kernel(20), atol=self.atol))
+
+    def test_lti_kernel_aliases(self):
+        # Every alias of the bilinear discretization takes the DPLR kernel, which matches the dense one
+        for discretization in ['bilinear', 'tustin']:
+            cell = LegendreTranslateCell(1, 16, memory_order=8, dt=0.1, discretization=discretization)
+            K = cell.kernel(20)
+            self.assertTrue(hasattr(cell, 'dplr'))
+            self.assertTrue(torch.allclose(K, LTICell.kernel(cell, 20), atol=self.atol))
+
+    def test_memory_dtype(self):
+        torch.manual_seed(0)
+        cell = LegendreScaleCell(1, 16, memory_order=32, max_length=64)
+        inputs = torch.randn(64, 4, 1)
+        for memory_dtype, dtype, atol in [('float16', torch.float16, 1e-3), ('bfloat16', torch.bfloat16, 2e-2), ('int8', torch.int8, 5e-2)]:
+            cell_q = LegendreScaleCell(1, 16, memory_order=32, max_length=64, memory_dtype=memory_dtype)
+            cell_q.load_state_dict(cell.state_dict(), strict=False)
+            # Calibrate the int8 scales in training mode
+            RNN(cell_q.train())(inputs)
+            out, (_, m, _) = RNN(cell.eval())(inputs, return_output=True)
+            out_q, (_, m_q, _) = RNN(cell_q.eval())(inputs, return_output=True)
+            self.assertEqual(m_q.dtype, dtype)
+            self.assertTrue(torch.allclose(out, out_q, atol=atol))
+            # Inference rounds to nearest, and is deterministic
+            out_q2, _ = RNN(cell_q)(inputs, return_output=True)
+            self.assertTrue(torch.equal(out_q, out_q2))
+
+    def test_memory_int8_uncalibrated(self):
+        cell = LegendreScaleCell(1, 16, memory_order=32, max_length=64, memory_dtype='int8').eval()
+        with self.assertRaises(RuntimeError):
+            RNN(cell)(torch.randn(8, 4, 1))
+
+    def test_micro_batcher_matches_sequential(self):
+        nsessions = 5
+        nsteps = 4
+        cell = LegendreScaleCell(1, 16, memory_order=8, max_length=16)
+        inputs = torch.randn(nsessions, nsteps, 1)
+
+        async def run():
+            batcher = MicroBatcher(cell, max_batch=8, max_wait=1e-3)
+            ids = [batcher.open_session() for _ in range(nsessions)]
+            batcher.start()
+            outputs = [[] for _ in ids]
+            # Session i joins at round i, so that batches mix streams at different time steps
+            for r in range(nsessions + nsteps - 1):
+                active = [i for i in ids if 0 <= r - i < nsteps]
+                results = await asyncio.gather(*[batcher.step(i, inputs[i, r - i]) for i in active])
+                for i, output in zip(active, results):
+                    outputs[i].append(output)
+            await batcher.stop()
+            return torch.stack([torch.stack(o, dim=0) for o in outputs], dim=0)
+
+        outputs = asyncio.run(run())
+        with torch.no_grad():
+            state = cell.default_state(inputs[:, 0], nsessions)
+            expected = []
+            for k in range(nsteps):
+                output, state = cell(inputs[:, k], state)
+                expected.append(output)
+        expected = torch.stack(expected, dim=1)
+        self.assertTrue(torch.allclose(outputs, expected, atol=self.atol))
+
+    def test_micro_batcher_repeated_and_unknown_sessions(self):
+        cell = LegendreScaleCell(1, 16, memory_order=8, max_length=16)
+        inputs = torch.randn(3, 1)
+
+        async def run():
+            batcher = MicroBatcher(cell, max_batch=8, max_wait=1e-3)
+            session = batcher.open_session()
+            batcher.start()
+            # Two steps of the same session in flight at once are served one after the other
+            outputs = await asyncio.wait_for(asyncio.gather(batcher.step(session, inputs[0]), batcher.step(session, inputs[1])), 5)
+            # A request of an unknown session fails alone
+            results = await asyncio.wait_for(asyncio.gather(batcher.step(session, inputs[2]), batcher.step(-1, inputs[2]),
+                                                            return_exceptions=True), 5)
+            await batcher.stop()
+            return outputs + [results[0]], results[1]
+
+        outputs, error = asyncio.run(run())
+        self.assertIsInstance(error, KeyError)
+        with torch.no_grad():
+            state = cell.default_state(inputs[:1], 1)
+            for k in range(3):
+                output, state = cell(inputs[k:k+1], state)
+                self.assertTrue(torch.allclose(outputs[k], output[0], atol=self.atol))
+
+    def test_micro_batcher_cancelled_request(self):
+        cell = LegendreScaleCell(1, 16, memory_order=8, max_length=16)
+
+        async def run():
+            batcher = MicroBatcher(cell, max_batch=8, max_wait=1e-2)
+            session = batcher.open_session()
+            other = batcher.open_session()
+            batcher.start()
+            # Cancelled while waiting for its batch to be collected
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(batcher.step(session, torch.randn(1)), 1e-3)
+            output = await asyncio.wait_for(batcher.step(other, torch.randn(1)), 5)
+            self.assertFalse(batcher._worker.done())
+            await batcher.stop()
+            return output
+
+        self.assertEqual(asyncio.run(run()).shape, (16,))
+
+
+class StateIOTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        batch_size = 7
+        h = torch.randn(batch_size, 16)
+        m = torch.randn(batch_size, 2, 9)
+        time_step = torch.randint(0, 100, (batch_size,))
+        ids = torch.arange(batch_size) * 3
+        for m_dtype in [torch.float32, torch.float16, torch.bfloat16]:
+            f = io.BytesIO()
+            state_io.save_state(f, (h, m, time_step), ids, m_dtype=m_dtype)
+            (h_, m_, time_step_), ids_ = state_io.load_state(bytearray(f.getvalue()))
+            self.assertEqual(m_.dtype, m_dtype)
+            self.assertTrue(torch.equal(h_, h))
+            self.assertTrue(torch.equal(m_, m.to(m_dtype)))
+            self.assertTrue(torch.equal(time_step_, time_step))
+            self.assertTrue(torch.equal(ids_, ids))
+
+    def test_checkpoint(self):
+        cell = LegendreScaleCell(1, 16, memory_order=8, max_length=16)
+        inputs = torch.randn(3, 1)
+
+        async def step(batcher, session, input):
+            batcher.start()
+            output = await asyncio.wait_for(batcher.step(session, input), 5)
+            await batcher.stop()
+            return output
+
+        with tempfile.TemporaryDirectory() as directory:
+            # An empty checkpoint
+            MicroBatcher(cell).save(f'{directory}/empty.bin')
+            batcher = MicroBatcher(cell)
+            batcher.restore(f'{directory}/empty.bin')
+            self.assertEqual(batcher.sessions, {})
+            # Sessions restored from a checkpoint continue where they were, and new sessions get new ids
+            batcher = MicroBatcher(cell)
+            sessions = [batcher.open_session() for _ in range(2)]
+            asyncio.run(step(batcher, sessions[1], inputs[0]))
+            batcher.save(f'{directory}/state.bin')
+            restored = MicroBatcher(cell)
+            restored.restore(f'{directory}/state.bin')
+            self.assertEqual(sorted(restored.sessions), sessions)
+            new = restored.open_session()
+            self.assertNotIn(new, sessions)
+            self.assertTrue(torch.allclose(asyncio.run(step(restored, sessions[1], inputs[1])),
+                                           asyncio.run(step(batcher, sessions[1], inputs[1])), atol=1e-5))
+            self.assertEqual(asyncio.run(step(restored, new, inputs[2])).shape, (16,))
+            # Checkpoints only store integer ids
+            batcher.open_session('a')
+            with self.assertRaises(AssertionError):
+                batcher.save(f'{directory}/state.bin')
@@ -0,0 +1,126 @@
+import unittest
+
+import torch
+
+from datasets.copying import torch_copying_data
+from model.model import Model
+from model.opcell import LegendreScaleCell
+from model.qrnn import QRNN
+from model.rnn import RNN, BidirectionalRNN
+
+
+class StackedRNNTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.atol = 1e-5
+
+    def test_wavefront_matches_sequential(self):
+        batch_size = 4
+        length = 12
+        inputs = torch.randn(batch_size, length, 1)
+        for cell, cell_args in [('legs', {'max_length': length}), ('legs', {'max_length': length, 'memory_dtype': 'bfloat16'}),
+                                ('legt', {}), ('rnn', {})]:
+            model = Model(1, 10, output_len=3, cell=cell, cell_args={'hidden_size': 16, **cell_args}, num_layers=4)
+            if 'memory_dtype' in cell_args:
+                model(inputs) # stochastic rounding in training mode, vectorized over the layers
+                model.eval() # rounds to nearest, so that both orders compute the same
+            results = []
+            for wavefront in [True, False]:
+                model.rnn.wavefront = wavefront
+                model.zero_grad()
+                outputs = model(inputs)
+                outputs.sum().backward()
+                results.append((outputs, [p.grad.clone() for p in model.parameters()]))
+            (out, grads), (out_seq, grads_seq) = results
+            self.assertTrue(torch.allclose(out, out_seq, atol=self.atol))
+            for g, g_seq in zip(grads, grads_seq):
+                self.assertTrue(torch.allclose(g, g_seq, atol=self.atol))
+
+
+class BidirectionalRNNTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.atol = 1e-5
+
+    def test_matches_two_passes(self):
+        length = 10
+        lengths = torch.tensor([10, 3, 7, 1])
+        inputs = torch.randn(length, len(lengths), 2)
+        packed = torch.nn.utils.rnn.pack_padded_sequence(inputs, lengths, enforce_sorted=False)
+        cell = LegendreScaleCell(2, 16, memory_order=8, max_length=length)
+        cell_reverse = LegendreScaleCell(2, 16, memory_order=8, max_length=length)
+        for rnn, reverse in [(BidirectionalRNN(cell), cell), (BidirectionalRNN(cell, cell_reverse), cell_reverse),
+                             (BidirectionalRNN(cell, cell_reverse, vectorize=True), cell_reverse)]:
+            outputs, state = rnn(packed, return_output=True)
+            for b, n in enumerate(lengths.tolist()):
+                x = inputs[:n, b:b+1]
+                outputs_forward, state_forward = RNN(cell)(x, return_output=True)
+                outputs_reverse, state_reverse = RNN(reverse)(x.flip(0), return_output=True)
+                expected = torch.cat([outputs_forward, outputs_reverse.flip(0)], dim=-1)
+                self.assertTrue(torch.allclose(outputs[:n, b:b+1], expected, atol=self.atol))
+                self.assertTrue(torch.allclose(rnn.output(state)[b:b+1],
+                                               torch.cat([cell.output(state_forward), reverse.output(state_reverse)], dim=-1),
+                                               atol=self.atol))
+
+
+class QRNNTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.atol = 1e-5
+
+    def test_f_pooling(self):
+        length, batch_size = 50, 4
+        lengths = torch.tensor([50, 20, 1, 33])
+        qrnn = QRNN(3, 16, memory_order=8, max_length=length)
+        inputs = torch.randn(length, batch_size, 3)
+        outputs, state = qrnn(inputs, return_output=True)
+        # Sequential f-pooling over the same gates
+        c = qrnn.memory(qrnn.W_u(inputs))
+        z, f = qrnn.W_zf(torch.cat((inputs, c.view(length, batch_size, -1)), dim=-1)).chunk(2, dim=-1)
+        z, f = torch.tanh(z), torch.sigmoid(f)
+        h = torch.zeros(batch_size, 16)
+        expected = []
+        for t in range(length):
+            h = f[t] * h + (1 - f[t]) * z[t]
+            expected.append(h)
+        expected = torch.stack(expected)
+        self.assertTrue(torch.allclose(outputs, expected, atol=self.atol))
+        self.assertTrue(torch.allclose(state, expected[-1], atol=self.atol))
+        _, state = qrnn(torch.nn.utils.rnn.pack_padded_sequence(inputs, lengths, enforce_sorted=False))
+        self.assertTrue(torch.allclose(state, expected[lengths - 1, torch.arange(batch_size)], atol=self.atol))
+
+
+class TokenInputTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.atol = 1e-5
+
+    def test_one_hot_matches_dense(self):
+        L, M, A = 20, 4, 6
+        # The same samples as token ids and as one-hot vectors
+        tokens, targets = torch_copying_data(L, M, A, variable=True, batch_shape=(3,), generator=torch.Generator().manual_seed(1), one_hot=False)
+        dense, targets_ = torch_copying_data(L, M, A, variable=True, batch_shape=(3,), generator=torch.Generator().manual_seed(1))
+        self.assertEqual(tokens.dtype, torch.int16)
+        self.assertEqual(dense.dtype, torch.float32)
+        self.assertTrue(torch.equal(targets, targets_))
+        model = Model(A, A, output_len=M, cell='legt', cell_args={'hidden_size': 16}, embed_args={'one_hot': True})
+        model_dense = Model(A, A, output_len=M, cell='legt', cell_args={'hidden_size': 16})
+        model_dense.load_state_dict(model.state_dict())
+        self.assertTrue(torch.allclose(model(tokens), model_dense(dense), atol=self.atol))
+
+    def test_embedding(self):
+        L, M, A = 20, 4, 6
+        tokens, _ = torch_copying_data(L, M, A, variable=True, batch_shape=(3,), one_hot=False)
+        model = Model(A, A, output_len=M, cell='legt', cell_args={'hidden_size': 16}, embed_args={'embed_dim': 5})
+        outputs = model(tokens)
+        self.assertEqual(outputs.shape, (3, M, A))
+        self.assertTrue(torch.equal(outputs, model(tokens.long())))
+        outputs.sum().backward()
+        # Only the embeddings of the tokens that occur receive gradients
+        used = torch.zeros(A, dtype=torch.bool)
+        used[tokens.long().unique()] = True
+        self.assertTrue(torch.equal(model.embedding.weight.grad.abs().sum(dim=-1) > 0, used))
@@ -1,7 +1,7 @@
 from pathlib import Path
 project_root = Path(__file__).parent.absolute()
 import os
-# Add to $PYTHONPATH so that ray workers can see
+# Add to $PYTHONPATH so that worker processes can see
 os.environ['PYTHONPATH'] = str(project_root) + ":" + os.environ.get('PYTHONPATH', '')
 
 import numpy as np
@@ -12,7 +12,7 @@ import hydra
 from omegaconf import OmegaConf
 
 from model.model import Model
-from datasets import DatasetBase
+from datasets import DatasetBase, dataset_cache
 from model.exprnn.parametrization import get_parameters
 from utils import to_scalar
 
@@ -23,7 +23,11 @@ class RNNTraining(pl.LightningModule):
         super().__init__()
         self.save_hyperparameters()
         self.dataset_cfg = dataset_cfg
-        self.dataset = DatasetBase.registry[dataset_cfg.name](dataset_cfg) # 정확히 이게 뭐지?
+        # A dataset prepared ahead by the runner is reused as is
+        self.dataset = dataset_cache.get(OmegaConf.to_yaml(dataset_cfg))
+        self.dataset_prepared = self.dataset is not None
+        if self.dataset is None:
+            self.dataset = DatasetBase.registry[dataset_cfg.name](dataset_cfg) # 정확히 이게 뭐지?
         self.train_args = train_args
         self.model_args = model_args
         # self.model_args.cell_args.max_length = self.dataset.N # TODO fix datasets
@@ -51,8 +55,9 @@ class RNNTraining(pl.LightningModule):
         loss = self.dataset.loss(out, batch_y, len_batch)
         metrics = self.dataset.metrics(out, batch_y)
         metrics = {f'{prefix}_{k}': v for k, v in metrics.items()}
-        self.log(f'{prefix}_loss', loss, on_epoch=True, prog_bar=False)
-        self.log_dict(metrics, on_epoch=True, prog_bar=True)
+        # With data-parallel training, the epoch metrics are averaged over the ranks
+        self.log(f'{prefix}_loss', loss, on_epoch=True, prog_bar=False, sync_dist=self.world_size > 1)
+        self.log_dict(metrics, on_epoch=True, prog_bar=True, sync_dist=self.world_size > 1)
         return loss
 
     def training_step(self, batch, batch_idx):
@@ -78,10 +83,47 @@ class RNNTraining(pl.LightningModule):
         else:
             return optimizer(self.model.parameters(), lr=self.train_args.lr)
 
+    @property
+    def world_size(self):
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_world_size()
+        return 1
+
     def prepare_data(self):
-        self.dataset.prepare_data()
-        kwargs = {'num_workers': self.dataset_cfg.num_workers, 'pin_memory': True}
-        self.dataset.prepare_dataloader(self.train_args.batch_size, **kwargs)
+        # Only called on one process per node, e.g. to download the data
+        self.prepare_dataset()
+
+    def prepare_dataset(self):
+        # Once per process. With a seed (always set by pl_train for data-parallel runs), synthetic datasets and the
+        # train/val split are drawn from it, identically on every rank, so that the shards are disjoint
+        if self.dataset_prepared:
+            return
+        seed = os.environ.get('PL_GLOBAL_SEED')
+        with torch.random.fork_rng(enabled=seed is not None):
+            if seed is not None:
+                torch.manual_seed(int(seed))
+            self.dataset.prepare_data()
+        self.dataset_prepared = True
+
+    def setup(self, stage):
+        # Called on every rank, once the process group is initialized
+        if self.world_size > 1 and self.device.type == 'cpu':
+            # Split the cores of the node between its processes instead of oversubscribing them
+            torch.set_num_threads(max(1, os.cpu_count() // self.trainer.num_processes))
+        # The ranks that did not run prepare_data build their copy of the dataset here
+        self.prepare_dataset()
+        self.prepare_dataloader()
+
+    def prepare_dataloader(self):
+        world_size = self.world_size
+        rank = torch.distributed.get_rank() if world_size > 1 else 0
+        batch_size = self.train_args.batch_size
+        if world_size > 1 and self.train_args.get('scale_batch_size', True):
+            # train.batch_size is the global batch size
+            assert batch_size % world_size == 0, f"batch size {batch_size} is not divisible by the world size {world_size}"
+            batch_size //= world_size
+        kwargs = {'num_workers': self.dataset_cfg.num_workers, 'pin_memory': torch.cuda.is_available()}
+        self.dataset.prepare_dataloader(batch_size, num_replicas=world_size, rank=rank, **kwargs)
 
     def train_dataloader(self):
         return self.dataset.train_loader
@@ -98,15 +140,15 @@ def main(cfg: OmegaConf):
     # We want to add fields to cfg so need to call OmegaConf.set_struct
     OmegaConf.set_struct(cfg, False)
     print(OmegaConf.to_yaml(cfg)) # setting 출력
-    if cfg.runner.name == 'pl':
+    if cfg.runner.name == 'parallel' or (cfg.runner.name == 'pl' and cfg.runner.ntrials > 1):
+        # Several trials, run concurrently on this machine
+        from parallel_runner import parallel_train
+        parallel_train(cfg, RNNTraining)
+    elif cfg.runner.name == 'pl':
         from pl_runner import pl_train
         trainer, model = pl_train(cfg, RNNTraining)
-    elif cfg.runner.name == 'ray':
-        # Shouldn't need to install ray unless doing distributed training
-        from ray_runner import ray_train
-        ray_train(cfg, RNNTraining)
     else:
-        assert False, 'Only pl and ray runners are supported'
+        assert False, 'Only pl and parallel runners are supported'
 
 
 if __name__ == "__main__":